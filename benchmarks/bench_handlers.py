@@ -0,0 +1,311 @@
+"""In-process load benchmark for the bot's handlers.
+
+Builds synthetic Update/CallbackQuery objects and feeds them through the real handler
+routing (`register_handlers`). The Bot API, yfinance and Yahoo search are replaced by
+local fakes with configurable latency, so nothing leaves the machine. Reports throughput,
+p50/p95/p99 latency per handler and time spent in SQLite, tagged with the current commit:
+
+    python benchmarks/bench_handlers.py --users 200 --ops 5000 --output bench.json
+    python benchmarks/bench_handlers.py --compare bench.json   # flag regressions vs an earlier run
+"""
+import argparse
+import asyncio
+import csv
+import importlib
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Traffic mixes: {scenario: weight}
+MIXES = {
+    "realistic": {"menu": 50, "price": 25, "watchlist": 15, "search": 10},
+    "menu": {"menu": 1},
+    "price": {"price": 1},
+    "watchlist": {"watchlist": 1},
+    "search": {"search": 1},
+}
+
+def percentile(sorted_values: list, pct: float) -> float:
+    if not sorted_values: return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+class FakeTicker:
+    def __init__(self, yf, symbol: str):
+        self._yf = yf
+        self.symbol = symbol
+
+    @property
+    def info(self) -> dict:
+        self._yf.record("info")
+        time.sleep(self._yf.latency)
+        price = self._yf.price(self.symbol)
+        return {"regularMarketPrice": price, "regularMarketChange": price * 0.01, "regularMarketChangePercent": 0.01,
+                "currency": "INR" if self.symbol.endswith((".NS", ".BO")) else "USD", "longName": f"{self.symbol} Corp"}
+
+class FakeYFinance:
+    """Stands in for the yfinance module: Ticker(...).info and download(...) with fixed latency."""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls = {}
+        self._lock = threading.Lock()
+
+    def record(self, name: str) -> None:
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    @staticmethod
+    def price(symbol: str) -> float:
+        return 50 + (sum(map(ord, symbol)) % 400)
+
+    def Ticker(self, symbol: str, **kwargs) -> FakeTicker:
+        return FakeTicker(self, symbol)
+
+    def download(self, tickers, **kwargs):
+        import pandas as pd
+        self.record("download")
+        time.sleep(self.latency)
+        tickers = [tickers] if isinstance(tickers, str) else list(tickers)
+        index = pd.date_range(end=pd.Timestamp.today().normalize(), periods=5, freq="B")
+        fields = ["Open", "High", "Low", "Close", "Adj Close", "Volume"]
+        columns = pd.MultiIndex.from_product([tickers, fields], names=["Ticker", "Price"])
+        data = {(t, f): [self.price(t) * (1 + 0.01 * i) for i in range(5)] for t in tickers for f in fields}
+        return pd.DataFrame(data, index=index, columns=columns)
+
+class Benchmark:
+    def __init__(self, bot, args):
+        self.bot = bot
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.latencies = {} # handler label -> [seconds]
+        self.errors = 0
+        self.sqlite_seconds = 0.0
+        self.sqlite_statements = 0
+        self._sqlite_lock = threading.Lock()
+        self._update_id = 0
+        with open(bot.SYMBOLS_FILE, newline="") as f:
+            self.symbols = [row["symbol"] for row in csv.DictReader(f) if not row["symbol"].startswith("^")]
+
+    # --- Fakes ---
+    def install_fakes(self):
+        from fake_telegram import FakeBotApi
+        import httpx
+        from telegram.request import BaseRequest
+
+        bot, args = self.bot, self.args
+        self.api = api = FakeBotApi(args.api_latency)
+
+        class FakeBotRequest(BaseRequest):
+            """Answers Bot API calls in-process from FakeBotApi instead of going over HTTP."""
+            @property
+            def read_timeout(self):
+                return None
+            async def initialize(self):
+                pass
+            async def shutdown(self):
+                pass
+            async def do_request(self, url, method, request_data=None, **kwargs):
+                params = request_data.parameters if request_data else {}
+                return 200, await api.respond(url.rsplit("/", 1)[-1], params)
+
+        self.fake_request = FakeBotRequest
+        self.yf = bot.yf = FakeYFinance(args.yahoo_latency)
+        # The bot imports pandas/numpy lazily; pay that once here so it isn't timed as handler latency
+        importlib.import_module("pandas")
+        importlib.import_module("numpy")
+
+        self.search_calls = 0
+        async def fake_search(request):
+            self.search_calls += 1
+            await asyncio.sleep(args.yahoo_latency)
+            term = request.url.params.get("q", "")
+            quotes = [{"symbol": f"{term.upper()[:6]}{i}.NS", "longname": f"{term.title()} Holdings {i}", "exchange": "NSI"} for i in range(3)]
+            return httpx.Response(200, json={"quotes": quotes})
+        bot._http_client = httpx.AsyncClient(transport=httpx.MockTransport(fake_search))
+
+        database = bot.database
+        read, apply_writes = database._read, database._apply_writes
+        def timed(func):
+            def wrapper(*a, **kw):
+                started = time.perf_counter()
+                try:
+                    return func(*a, **kw)
+                finally:
+                    with self._sqlite_lock:
+                        self.sqlite_seconds += time.perf_counter() - started
+                        self.sqlite_statements += len(a[0]) if func is apply_writes else 1
+            return wrapper
+        database._read, database._apply_writes = timed(read), timed(apply_writes)
+
+    # --- Synthetic updates ---
+    def next_id(self) -> int:
+        self._update_id += 1
+        return self._update_id
+
+    def _user(self, user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"user{user_id}"}
+
+    def command(self, user_id: int, text: str) -> dict:
+        command = text.split()[0]
+        return {"update_id": self.next_id(), "message": {
+            "message_id": self._update_id, "date": int(time.time()), "chat": {"id": user_id, "type": "private"},
+            "from": self._user(user_id), "text": text, "entities": [{"type": "bot_command", "offset": 0, "length": len(command)}]}}
+
+    def tap(self, user_id: int, data: str) -> dict:
+        return {"update_id": self.next_id(), "callback_query": {
+            "id": str(self._update_id), "from": self._user(user_id), "chat_instance": str(user_id), "data": data,
+            "message": {"message_id": 1, "date": int(time.time()), "chat": {"id": user_id, "type": "private"}, "text": "menu"}}}
+
+    def scenario(self, name: str, user_id: int) -> list:
+        """One user journey as a list of raw update dicts."""
+        rng, bot = self.rng, self.bot
+        symbol = rng.choice(self.symbols)
+        if name == "menu":
+            category = rng.choice(sorted(bot.FINANCIAL_LINKS))
+            return [self.command(user_id, "/start"), self.tap(user_id, "show_resources_menu"), self.tap(user_id, category),
+                    self.tap(user_id, "show_more_tools"), self.tap(user_id, "main_menu")]
+        if name == "price":
+            toggle = "remove_from_details_" if rng.random() < 0.5 else "add_from_details_"
+            return [self.command(user_id, f"/price {symbol}"), self.tap(user_id, f"price_{symbol}"), self.tap(user_id, f"{toggle}{symbol}")]
+        if name == "watchlist":
+            return [self.tap(user_id, "show_watchlist"), self.command(user_id, "/watchlist")]
+        if name == "search":
+            # Mostly names the local index knows, some it doesn't (remote fallback)
+            term = rng.choice(["tata", "hdfc", "reliance", "apple", "infosys", "bank"]) if rng.random() < 0.8 else f"unknown{rng.randint(1, 50)}"
+            return [self.command(user_id, f"/search {term}")]
+        raise ValueError(name)
+
+    def label(self, raw: dict) -> str:
+        if "message" in raw:
+            return raw["message"]["text"].split()[0].lstrip("/") + "_command"
+        data = raw["callback_query"]["data"]
+        for prefix in ("price_", "add_from_search_", "add_from_details_", "remove_from_details_", "remove_from_list_", "quiz_"):
+            if data.startswith(prefix): return f"button:{prefix}"
+        return "button:<category>" if data in self.bot.FINANCIAL_LINKS else f"button:{data}"
+
+    # --- Run ---
+    async def run(self) -> dict:
+        from telegram import Update
+        from telegram.ext import Application
+
+        bot, args = self.bot, self.args
+        application = Application.builder().token("123456:FAKE-TOKEN").request(self.fake_request()).get_updates_request(self.fake_request()).build()
+        bot.register_handlers(application)
+        application.add_error_handler(self.on_error)
+        await application.initialize()
+
+        # Seed watchlists so watchlist renders have something to fetch
+        for user_id in range(1, args.users + 1):
+            for symbol in self.rng.sample(self.symbols, min(args.watchlist_size, len(self.symbols))):
+                await bot.watchlist_index.add(user_id, symbol)
+        bot.quote_cache._entries.clear()
+
+        mix = MIXES[args.mix]
+        names, weights = list(mix), list(mix.values())
+        remaining = args.ops
+
+        async def virtual_user(user_id: int):
+            nonlocal remaining
+            while remaining > 0:
+                journey = self.scenario(self.rng.choices(names, weights)[0], user_id)
+                for raw in journey:
+                    if remaining <= 0: return
+                    remaining -= 1
+                    update = Update.de_json(raw, application.bot)
+                    started = time.perf_counter()
+                    await application.process_update(update)
+                    self.latencies.setdefault(self.label(raw), []).append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(virtual_user(user_id) for user_id in range(1, args.users + 1)))
+        elapsed = time.perf_counter() - started
+        await application.shutdown()
+        await bot.database.close()
+        return self.report(elapsed)
+
+    async def on_error(self, update, context):
+        self.errors += 1
+        if self.errors <= 3:
+            print(f"handler error: {context.error!r}", file=sys.stderr)
+
+    def report(self, elapsed: float) -> dict:
+        ops = sum(len(v) for v in self.latencies.values())
+        handlers = {}
+        for label, values in sorted(self.latencies.items()):
+            values.sort()
+            handlers[label] = {"count": len(values), "mean_ms": 1000 * sum(values) / len(values),
+                               "p50_ms": 1000 * percentile(values, 50), "p95_ms": 1000 * percentile(values, 95), "p99_ms": 1000 * percentile(values, 99)}
+        try:
+            commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=BENCH_DIR).stdout.strip()
+        except OSError:
+            commit = ""
+        return {
+            "commit": commit, "config": {k: v for k, v in vars(self.args).items() if k not in ("output", "compare")},
+            "ops": ops, "seconds": elapsed, "ops_per_second": ops / elapsed, "errors": self.errors,
+            "sqlite": {"seconds": self.sqlite_seconds, "statements": self.sqlite_statements,
+                       "ms_per_op": 1000 * self.sqlite_seconds / ops if ops else 0},
+            "upstream": {"yfinance": dict(self.yf.calls), "yahoo_search": self.search_calls, "telegram": dict(self.api.calls)},
+            "quote_cache": self.bot.quote_cache.stats(),
+            "handlers": handlers,
+        }
+
+def compare(current: dict, baseline: dict, threshold: float) -> list:
+    """Returns human-readable regressions: throughput drops or p95 increases beyond threshold %."""
+    regressions = []
+    if current["ops_per_second"] < baseline["ops_per_second"] * (1 - threshold / 100):
+        regressions.append(f"throughput {baseline['ops_per_second']:.1f} -> {current['ops_per_second']:.1f} ops/s")
+    for label, stats in current["handlers"].items():
+        before = baseline["handlers"].get(label)
+        if before and stats["p95_ms"] > before["p95_ms"] * (1 + threshold / 100) and stats["p95_ms"] - before["p95_ms"] > 5:
+            regressions.append(f"{label} p95 {before['p95_ms']:.1f} -> {stats['p95_ms']:.1f} ms")
+    return regressions
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100, help="concurrent virtual users")
+    parser.add_argument("--ops", type=int, default=3000, help="total updates to replay")
+    parser.add_argument("--mix", choices=sorted(MIXES), default="realistic")
+    parser.add_argument("--api-latency", type=float, default=0.02, help="fake Bot API latency in seconds")
+    parser.add_argument("--yahoo-latency", type=float, default=0.15, help="fake yfinance/search latency in seconds")
+    parser.add_argument("--quote-ttl", type=float, default=60)
+    parser.add_argument("--watchlist-size", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="write the JSON report here")
+    parser.add_argument("--compare", help="earlier JSON report to compare against")
+    parser.add_argument("--threshold", type=float, default=20, help="regression threshold in percent")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Configuration is read at import time, so set it before loading the bot
+        os.environ.update(DB_PATH=os.path.join(tmp, "bench.db"), QUOTE_CACHE_TTL=str(args.quote_ttl),
+                          CLOSED_MARKET_QUOTE_TTL=str(args.quote_ttl), YAHOO_MAX_REQUESTS_PER_SECOND="1000")
+        sys.path.insert(0, BENCH_DIR)
+        from fake_telegram import load_bot_module
+        bot = load_bot_module()
+        bot.setup_database()
+        bot.load_symbol_index()
+        benchmark = Benchmark(bot, args)
+        benchmark.install_fakes()
+        result = asyncio.run(benchmark.run())
+
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(result, json.load(f), args.threshold)
+        for line in regressions:
+            print(f"REGRESSION: {line}", file=sys.stderr)
+        sys.exit(1 if regressions else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""Cold-start benchmark: how long until a freshly launched bot can answer its first update.
+
+Measures, each in a fresh interpreter and against a database seeded with users, watchlists
+and price alerts, (1) the bot module's import and boot (database setup plus loading symbols,
+alerts and quiz) times and which heavy third-party modules were loaded by then, and (2) the
+time from spawning the bot in webhook mode against the fake Bot API to the first answered /start:
+
+    python benchmarks/cold_start.py --runs 5
+"""
+import argparse
+import asyncio
+import json
+import os
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from fake_telegram import BOT_FILE, FAKE_TOKEN, FakeBotApi, free_port, load_bot_module, synthetic_update
+
+HEAVY_MODULES = ("yfinance", "pandas", "numpy", "requests", "curl_cffi")
+
+BOOT_PROBE = f"""
+import importlib.util, json, sys, time
+heavy = lambda: [m for m in {HEAVY_MODULES!r} if m in sys.modules]
+started = time.perf_counter()
+spec = importlib.util.spec_from_file_location("financial_links_bot", {BOT_FILE!r})
+bot = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(bot)
+imported, import_modules = time.perf_counter(), heavy()
+bot.setup_database(); bot.load_symbol_index(); bot.load_alerts(); bot.load_quiz_bank()
+print(json.dumps({{"import_seconds": imported - started, "boot_seconds": time.perf_counter() - imported,
+                  "heavy_modules_at_import": import_modules, "heavy_modules_at_boot": heavy()}}))
+"""
+
+def seed_database(path: str, users: int = 200) -> None:
+    """Creates a database like a live one: every user has a few watched symbols and price alerts."""
+    conn = sqlite3.connect(path)
+    conn.execute("""CREATE TABLE watchlist (watchlist_id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL,
+                    ticker_symbol TEXT NOT NULL, UNIQUE(user_id, ticker_symbol))""")
+    conn.execute("""CREATE TABLE alerts (alert_id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, ticker_symbol TEXT NOT NULL,
+                    kind TEXT NOT NULL, threshold REAL NOT NULL, created TEXT)""")
+    symbols = ["AAPL", "MSFT", "TSLA", "RELIANCE.NS", "TCS.NS", "INFY.NS"]
+    conn.executemany("INSERT INTO watchlist (user_id, ticker_symbol) VALUES (?, ?)",
+                     [(u, symbols[(u + i) % len(symbols)]) for u in range(1, users + 1) for i in range(3)])
+    conn.executemany("INSERT INTO alerts (user_id, ticker_symbol, kind, threshold, created) VALUES (?, ?, ?, ?, datetime('now'))",
+                     [(u, symbols[u % len(symbols)], ("above", "below", "move")[u % 3], 100 + u) for u in range(1, users + 1)])
+    conn.commit()
+    conn.close()
+
+def measure_boot() -> dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        seed_database(os.path.join(tmp, "cold.db"))
+        env = dict(os.environ, DB_PATH=os.path.join(tmp, "cold.db"))
+        output = subprocess.run([sys.executable, "-c", BOOT_PROBE], env=env, capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+async def measure_first_reply(api_server_port: int, api: FakeBotApi) -> float:
+    """Spawns the bot and keeps POSTing one /start until the webhook accepts it and the reply arrives."""
+    webhook_port = free_port()
+    api.replies, api.expected_replies = 0, 1
+    api.replied.clear()
+    with tempfile.TemporaryDirectory() as tmp:
+        seed_database(os.path.join(tmp, "cold.db"))
+        env = dict(os.environ, BOT_MODE="webhook", BOT_TOKEN=FAKE_TOKEN, WEBHOOK_PORT=str(webhook_port),
+                   TELEGRAM_API_BASE_URL=f"http://127.0.0.1:{api_server_port}", DB_PATH=os.path.join(tmp, "cold.db"),
+                   QUOTE_REFRESH_ENABLED="0")
+        started = time.perf_counter()
+        process = subprocess.Popen([sys.executable, BOT_FILE], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{webhook_port}") as client:
+                while True:
+                    try:
+                        if (await client.post("/telegram", json=synthetic_update(1, 42))).status_code == 200: break
+                    except httpx.TransportError:
+                        pass
+                    if process.poll() is not None: raise RuntimeError("Bot exited before answering")
+                    await asyncio.sleep(0.01)
+                await asyncio.wait_for(api.replied.wait(), timeout=60)
+            return time.perf_counter() - started
+        finally:
+            process.terminate()
+            process.wait(timeout=30)
+
+async def run(runs: int) -> dict:
+    bot = load_bot_module() # Only for its HttpServer; the measured bots run in their own processes
+    api = FakeBotApi(latency=0)
+    api_server = bot.HttpServer(api.handle, "127.0.0.1", 0)
+    await api_server.start()
+    try:
+        boots = [measure_boot() for _ in range(runs)]
+        first_replies = [await measure_first_reply(api_server.port, api) for _ in range(runs)]
+    finally:
+        await api_server.stop()
+    return {"runs": runs,
+            "import_seconds_median": statistics.median(r["import_seconds"] for r in boots),
+            "boot_seconds_median": statistics.median(r["boot_seconds"] for r in boots),
+            "heavy_modules_at_import": boots[-1]["heavy_modules_at_import"],
+            "heavy_modules_at_boot": boots[-1]["heavy_modules_at_boot"],
+            "first_reply_seconds_median": statistics.median(first_replies),
+            "first_reply_seconds": first_replies}
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args.runs))))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+"""Local stand-in for the Telegram Bot API plus a webhook load driver.
+
+Starts a fake Bot API server, launches the bot in webhook mode against it (no real
+token or network needed), POSTs synthetic updates at the webhook and reports how long
+the bot takes to answer all of them:
+
+    python benchmarks/fake_telegram.py --updates 2000 --users 200 --api-latency 0.05
+    python benchmarks/fake_telegram.py --compare      # sequential vs concurrent processing
+"""
+import argparse
+import asyncio
+import importlib.util
+import json
+import logging
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.parse import parse_qs
+
+import httpx
+
+BOT_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "financial_links_bot.py.py")
+FAKE_TOKEN = "123456:FAKE-TOKEN-FOR-LOAD-TESTS"
+
+def load_bot_module():
+    """Imports the bot script as a module (its file name isn't importable directly)."""
+    spec = importlib.util.spec_from_file_location("financial_links_bot", BOT_FILE)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["financial_links_bot"] = module
+    spec.loader.exec_module(module)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    return module
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+class FakeBotApi:
+    """Answers Bot API methods with plausible results after a configurable latency."""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls = {}
+        self.replies = 0 # sendMessage + editMessageText, i.e. one per handled update
+        self.replied = asyncio.Event()
+        self.expected_replies = None
+        self._message_id = 0
+
+    def _message(self, params: dict) -> dict:
+        self._message_id += 1
+        chat_id = int(params.get("chat_id") or 0)
+        return {"message_id": self._message_id, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"}, "text": params.get("text", "")}
+
+    async def handle(self, method: str, path: str, headers: dict, body: bytes) -> tuple:
+        if headers.get("content-type", "").startswith("application/json"):
+            params = json.loads(body or b"{}")
+        else:
+            params = {k: v[0] for k, v in parse_qs(body.decode()).items()}
+        return 200, "application/json", await self.respond(path.rsplit("/", 1)[-1], params)
+
+    async def respond(self, api_method: str, params: dict) -> bytes:
+        """Returns the JSON body Telegram would send for api_method."""
+        self.calls[api_method] = self.calls.get(api_method, 0) + 1
+        if self.latency: await asyncio.sleep(self.latency)
+        if api_method == "getMe":
+            result = {"id": 123456, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}
+        elif api_method in ("sendMessage", "editMessageText", "editMessageReplyMarkup"):
+            result = self._message(params)
+        else:
+            result = True
+        if api_method in ("sendMessage", "editMessageText"):
+            self.replies += 1
+            if self.expected_replies is not None and self.replies >= self.expected_replies:
+                self.replied.set()
+        return json.dumps({"ok": True, "result": result}).encode()
+
+def synthetic_update(update_id: int, user_id: int) -> dict:
+    """Alternates /start commands with resource-menu taps, the bot's cheapest two paths."""
+    user = {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+    chat = {"id": user_id, "type": "private"}
+    if update_id % 2:
+        return {"update_id": update_id, "message": {
+            "message_id": update_id, "date": int(time.time()), "chat": chat, "from": user, "text": "/start",
+            "entities": [{"type": "bot_command", "offset": 0, "length": 6}]}}
+    return {"update_id": update_id, "callback_query": {
+        "id": str(update_id), "from": user, "chat_instance": str(user_id), "data": "show_resources_menu",
+        "message": {"message_id": 1, "date": int(time.time()), "chat": chat, "text": "menu"}}}
+
+async def wait_for_port(port: int, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise TimeoutError(f"Bot did not start listening on port {port}")
+
+async def run_load(updates: int, users: int, api_latency: float, concurrent_updates: int, senders: int) -> dict:
+    bot = load_bot_module()
+    api = FakeBotApi(api_latency)
+    api_server = bot.HttpServer(api.handle, "127.0.0.1", 0)
+    await api_server.start()
+    webhook_port = free_port()
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, BOT_MODE="webhook", BOT_TOKEN=FAKE_TOKEN, WEBHOOK_PORT=str(webhook_port),
+                   TELEGRAM_API_BASE_URL=f"http://127.0.0.1:{api_server.port}", CONCURRENT_UPDATES=str(concurrent_updates),
+                   DB_PATH=os.path.join(tmp, "bench.db"), QUOTE_REFRESH_ENABLED="0")
+        process = subprocess.Popen([sys.executable, BOT_FILE], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            await wait_for_port(webhook_port)
+            api.expected_replies = updates
+            payloads = [synthetic_update(i + 1, random.randint(1, users)) for i in range(updates)]
+            rejected = 0
+            async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{webhook_port}", limits=httpx.Limits(max_connections=senders)) as client:
+                async def sender(chunk):
+                    nonlocal rejected
+                    for payload in chunk:
+                        while (await client.post("/telegram", json=payload)).status_code == 503:
+                            rejected += 1 # Backpressure: retry like Telegram would
+                            await asyncio.sleep(0.05)
+                started = time.perf_counter()
+                await asyncio.gather(*(sender(payloads[i::senders]) for i in range(senders)))
+                await asyncio.wait_for(api.replied.wait(), timeout=600)
+                elapsed = time.perf_counter() - started
+        finally:
+            process.terminate()
+            process.wait(timeout=30)
+            await api_server.stop()
+    return {"concurrent_updates": concurrent_updates, "updates": updates, "seconds": elapsed,
+            "updates_per_second": updates / elapsed, "rejected_503": rejected, "api_calls": api.calls}
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--updates", type=int, default=1000)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--api-latency", type=float, default=0.05, help="seconds the fake Bot API waits per call")
+    parser.add_argument("--concurrent-updates", type=int, default=256)
+    parser.add_argument("--senders", type=int, default=20, help="parallel webhook POST connections")
+    parser.add_argument("--compare", action="store_true", help="also run with sequential update processing")
+    args = parser.parse_args()
+
+    modes = [1, args.concurrent_updates] if args.compare else [args.concurrent_updates]
+    for concurrent_updates in modes:
+        result = asyncio.run(run_load(args.updates, args.users, args.api_latency, concurrent_updates, args.senders))
+        print(json.dumps(result))
+
+if __name__ == "__main__":
+    main()
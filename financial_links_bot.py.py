@@ -1,27 +1,116 @@
+from __future__ import annotations # Annotations stay unevaluated, so they don't import numpy at startup
 import logging
 import os
 import sqlite3
-import yfinance as yf
-import requests
+import importlib
+import httpx
 import random
 import asyncio
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, CallbackQuery
-from telegram.error import BadRequest
-from telegram.ext import Application, CommandHandler, ContextTypes, CallbackQueryHandler
+import json
+import signal
+import time
+import threading
+import weakref
+import re
+import csv
+import bisect
+import difflib
+from collections import OrderedDict
+from contextlib import contextmanager
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
+from functools import cache, partial
+from datetime import datetime, timedelta, time as dt_time
+from zoneinfo import ZoneInfo
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, CallbackQuery, InlineQueryResultArticle, InputTextMessageContent
+from telegram.error import BadRequest, Forbidden, RetryAfter
+from telegram.request import HTTPXRequest
+from telegram.ext import Application, BasePersistence, BaseUpdateProcessor, CommandHandler, ContextTypes, CallbackQueryHandler, InlineQueryHandler, PersistenceInput
 
 # Enable logging
 logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
 
+class LazyModule:
+    """Stand-in for a heavy module: the first attribute access imports it and rebinds the global to it."""
+
+    def __init__(self, name: str, alias: str):
+        self._name = name
+        self._alias = alias
+
+    def __getattr__(self, attr: str):
+        module = importlib.import_module(self._name)
+        if globals().get(self._alias) is self: globals()[self._alias] = module
+        return getattr(module, attr)
+
+# yfinance drags in pandas, numpy, requests and friends (~1s); none of it is needed to serve menus
+yf = LazyModule("yfinance", "yf")
+np = LazyModule("numpy", "np")
+
 # --- Constants ---
 OWNER_ID = 1727394308 # <<< IMPORTANT: YOUR TELEGRAM ID
-QUIZ_QUESTIONS = [
-    {"question": "What does a high P/E Ratio generally signify?", "options": ["The stock is undervalued", "Investors expect high future growth", "The company has low debt"], "correct": 1, "explanation": "A high P/E ratio often indicates that investors are willing to pay a higher price for each unit of current earnings, usually because they expect earnings to grow significantly in the future."},
-    {"question": "What is 'dollar-cost averaging'?", "options": ["Buying stocks only with USD", "Investing a fixed amount of money at regular intervals", "Selling stocks to average your cost basis"], "correct": 1, "explanation": "Dollar-cost averaging is an investment strategy where you invest a total sum of money in small increments over time instead of all at once. The goal is to reduce the impact of volatility."},
-    {"question": "What is a 'blue-chip' stock?", "options": ["A stock that costs less than $1", "A stock from a new tech company", "A well-established, financially sound company"], "correct": 2, "explanation": "Blue-chip stocks are from large, reputable, and financially stable companies that have a long history of reliable performance."},
-    {"question": "What is the primary benefit of a Systematic Investment Plan (SIP)?", "options": ["Guaranteed high returns", "Lump-sum investment profit", "Averaging cost & disciplined investing"], "correct": 2, "explanation": "SIPs help you invest regularly, which fosters discipline and averages out your purchase cost over time, reducing the risk of market timing."},
-    {"question": "A mutual fund is essentially a...", "options": ["Type of savings account", "Pool of money from many investors", "Government bond"], "correct": 1, "explanation": "A mutual fund pools money from many people to invest in a diversified portfolio of stocks, bonds, or other assets."},
-    {"question": "A 'bear market' is characterized by...", "options": ["Rising stock prices and optimism", "Falling stock prices and pessimism", "Volatile but stable prices"], "correct": 1, "explanation": "A bear market is a period of prolonged price declines and widespread pessimism. A 'bull market' is the opposite."},
-    {"question": "The 'power of compounding' refers to...", "options": ["Earning returns on your initial investment only", "Combining different types of stocks", "Earning returns on both your principal and past returns"], "correct": 2, "explanation": "Compounding is the process where your investment returns themselves start generating their own returns, leading to exponential growth over time."}
+DB_PATH = os.environ.get("DB_PATH", "bot_users.db")
+DB_READ_CONNECTIONS = int(os.environ.get("DB_READ_CONNECTIONS", "4")) # Reader threads, one connection each
+DB_DEFERRED_FLUSH_INTERVAL = float(os.environ.get("DB_DEFERRED_FLUSH_INTERVAL", "5")) # Seconds between batched user upserts
+WATCHLIST_INDEX_MAX_USERS = int(os.environ.get("WATCHLIST_INDEX_MAX_USERS", "50000")) # Users whose watchlists stay in memory
+USER_STATE_FLUSH_INTERVAL = float(os.environ.get("USER_STATE_FLUSH_INTERVAL", "10")) # Seconds between writes of changed user_data
+USER_STATE_IDLE_TIMEOUT = float(os.environ.get("USER_STATE_IDLE_TIMEOUT", "1800")) # Idle seconds before a user's state leaves memory
+QUOTE_CACHE_TTL = float(os.environ.get("QUOTE_CACHE_TTL", "60")) # Seconds a cached quote counts as fresh
+QUOTE_CACHE_MAX_ENTRIES = int(os.environ.get("QUOTE_CACHE_MAX_ENTRIES", "2000")) # LRU bound on cached symbols
+CLOSED_MARKET_QUOTE_TTL = float(os.environ.get("CLOSED_MARKET_QUOTE_TTL", "3600")) # Freshness of quotes while their market is shut
+QUOTE_REFRESH_ENABLED = os.environ.get("QUOTE_REFRESH_ENABLED", "1") == "1" # Background refresh of all watched symbols
+QUOTE_REFRESH_INTERVAL = float(os.environ.get("QUOTE_REFRESH_INTERVAL", "30")) # Per-symbol refresh cadence during market hours
+CLOSED_MARKET_REFRESH_INTERVAL = float(os.environ.get("CLOSED_MARKET_REFRESH_INTERVAL", "1800")) # ...and outside them
+QUOTE_REFRESH_TICK = float(os.environ.get("QUOTE_REFRESH_TICK", "5")) # How often the refresher looks for due symbols
+QUOTE_REFRESH_BATCH_SIZE = int(os.environ.get("QUOTE_REFRESH_BATCH_SIZE", "100")) # Symbols per bulk download
+ALERT_COOLDOWN = float(os.environ.get("ALERT_COOLDOWN", "14400")) # Seconds before a triggered alert can fire again
+MAX_ALERTS_PER_USER = int(os.environ.get("MAX_ALERTS_PER_USER", "50"))
+OUTBOX_WORKERS = int(os.environ.get("OUTBOX_WORKERS", "16")) # Concurrent sendMessage calls for queued notifications
+OUTBOX_MESSAGES_PER_SECOND = float(os.environ.get("OUTBOX_MESSAGES_PER_SECOND", "25")) # Global send rate; Telegram allows ~30/s
+OUTBOX_PER_CHAT_INTERVAL = float(os.environ.get("OUTBOX_PER_CHAT_INTERVAL", "1.1")) # Minimum seconds between messages to one chat
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get("OUTBOX_MAX_ATTEMPTS", "5")) # Transient failures before a message is given up
+INLINE_DEBOUNCE = float(os.environ.get("INLINE_DEBOUNCE", "0.35")) # Seconds an inline query waits for the next keystroke before doing work
+INLINE_QUOTE_TIMEOUT = float(os.environ.get("INLINE_QUOTE_TIMEOUT", "2")) # Longest wait for uncached quotes before answering without them
+INLINE_MAX_RESULTS = int(os.environ.get("INLINE_MAX_RESULTS", "8"))
+INLINE_MAX_CACHE_TIME = int(os.environ.get("INLINE_MAX_CACHE_TIME", "300")) # Upper bound on Telegram's server-side caching of answers
+BOT_MODE = os.environ.get("BOT_MODE", "polling") # "polling" or "webhook"
+CONCURRENT_UPDATES = int(os.environ.get("CONCURRENT_UPDATES", "256")) # Updates processed in parallel (1 = sequential)
+MAX_PENDING_UPDATES = int(os.environ.get("MAX_PENDING_UPDATES", "2000")) # Webhook backpressure: in-flight updates before 503
+MAX_PENDING_UPDATES_PER_USER = int(os.environ.get("MAX_PENDING_UPDATES_PER_USER", "20")) # Queued updates per user before dropping
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram")
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "") # Public base URL; when set, the webhook is registered with Telegram on start
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+TELEGRAM_API_BASE_URL = os.environ.get("TELEGRAM_API_BASE_URL", "") # Overrides https://api.telegram.org
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0")) # Prometheus text endpoint at /metrics; 0 disables it
+METRICS_LISTEN = os.environ.get("METRICS_LISTEN", "127.0.0.1")
+YAHOO_MAX_REQUESTS_PER_SECOND = float(os.environ.get("YAHOO_MAX_REQUESTS_PER_SECOND", "5")) # Global upstream rate limit
+UPSTREAM_CONCURRENCY = int(os.environ.get("UPSTREAM_CONCURRENCY", "8")) # Max in-flight Yahoo calls across all users
+UPSTREAM_TIMEOUT = float(os.environ.get("UPSTREAM_TIMEOUT", "10")) # Per-call timeout in seconds
+UPSTREAM_HEDGE_DELAY = float(os.environ.get("UPSTREAM_HEDGE_DELAY", "1.5")) # Seconds before a slow symbol search gets a second attempt; 0 disables
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get("CIRCUIT_FAILURE_THRESHOLD", "5")) # Consecutive upstream failures that open the circuit
+CIRCUIT_RESET_TIMEOUT = float(os.environ.get("CIRCUIT_RESET_TIMEOUT", "15")) # First cool-off before a half-open probe...
+CIRCUIT_MAX_RESET_TIMEOUT = float(os.environ.get("CIRCUIT_MAX_RESET_TIMEOUT", "300")) # ...doubling per consecutive opening up to this
+STALE_QUOTE_MAX_AGE = float(os.environ.get("STALE_QUOTE_MAX_AGE", "3600")) # Seconds past its TTL a quote is served while it refreshes
+HISTORY_DIR = os.environ.get("HISTORY_DIR", "price_history") # One memory-mapped .npy file of daily bars per symbol
+HISTORY_YEARS = float(os.environ.get("HISTORY_YEARS", "5")) # Depth of the first download for a new symbol
+HISTORY_MAX_OPEN = int(os.environ.get("HISTORY_MAX_OPEN", "512")) # LRU bound on mapped history files
+PORTFOLIO_BASE_CURRENCY = os.environ.get("PORTFOLIO_BASE_CURRENCY", "INR") # Currency portfolio totals are normalised to
+PORTFOLIO_RISK_WAIT = float(os.environ.get("PORTFOLIO_RISK_WAIT", "2")) # Seconds /portfolio waits for unsynced history before skipping risk
+SEARCH_CACHE_TTL = float(os.environ.get("SEARCH_CACHE_TTL", "86400")) # Seconds a remote search result is reused
+SEARCH_CACHE_MAX_ENTRIES = int(os.environ.get("SEARCH_CACHE_MAX_ENTRIES", "5000"))
+SYMBOLS_FILE = os.environ.get("SYMBOLS_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "symbols.csv"))
+CURRENCY_SYMBOLS = {'INR': '₹', 'USD': '$'}
+QUIZ_FILE = os.environ.get("QUIZ_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "quiz_questions.csv")) # Optional extra question bank
+QUIZ_INTERVALS = (600, 86400, 3 * 86400, 7 * 86400, 21 * 86400, 60 * 86400) # Review delay per Leitner box; a wrong answer resets to box 0
+QUIZ_QUESTIONS = [ # Built-in bank, seeded into quiz_questions with ids 1..n
+    {"category": "valuation", "difficulty": 2, "question": "What does a high P/E Ratio generally signify?", "options": ["The stock is undervalued", "Investors expect high future growth", "The company has low debt"], "correct": 1, "explanation": "A high P/E ratio often indicates that investors are willing to pay a higher price for each unit of current earnings, usually because they expect earnings to grow significantly in the future."},
+    {"category": "investing", "difficulty": 1, "question": "What is 'dollar-cost averaging'?", "options": ["Buying stocks only with USD", "Investing a fixed amount of money at regular intervals", "Selling stocks to average your cost basis"], "correct": 1, "explanation": "Dollar-cost averaging is an investment strategy where you invest a total sum of money in small increments over time instead of all at once. The goal is to reduce the impact of volatility."},
+    {"category": "stocks", "difficulty": 1, "question": "What is a 'blue-chip' stock?", "options": ["A stock that costs less than $1", "A stock from a new tech company", "A well-established, financially sound company"], "correct": 2, "explanation": "Blue-chip stocks are from large, reputable, and financially stable companies that have a long history of reliable performance."},
+    {"category": "investing", "difficulty": 1, "question": "What is the primary benefit of a Systematic Investment Plan (SIP)?", "options": ["Guaranteed high returns", "Lump-sum investment profit", "Averaging cost & disciplined investing"], "correct": 2, "explanation": "SIPs help you invest regularly, which fosters discipline and averages out your purchase cost over time, reducing the risk of market timing."},
+    {"category": "mutual_funds", "difficulty": 1, "question": "A mutual fund is essentially a...", "options": ["Type of savings account", "Pool of money from many investors", "Government bond"], "correct": 1, "explanation": "A mutual fund pools money from many people to invest in a diversified portfolio of stocks, bonds, or other assets."},
+    {"category": "markets", "difficulty": 1, "question": "A 'bear market' is characterized by...", "options": ["Rising stock prices and optimism", "Falling stock prices and pessimism", "Volatile but stable prices"], "correct": 1, "explanation": "A bear market is a period of prolonged price declines and widespread pessimism. A 'bull market' is the opposite."},
+    {"category": "investing", "difficulty": 2, "question": "The 'power of compounding' refers to...", "options": ["Earning returns on your initial investment only", "Combining different types of stocks", "Earning returns on both your principal and past returns"], "correct": 2, "explanation": "Compounding is the process where your investment returns themselves start generating their own returns, leading to exponential growth over time."}
 ]
 FINANCIAL_LINKS =  {
     "ipo_resources": {
@@ -125,26 +214,414 @@ FINANCIAL_LINKS =  {
     }
 }
 
+# --- Metrics ---
+class Histogram:
+    """Fixed-bucket latency histogram; observing is a bisect and two additions."""
+
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1) # Last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q-th observation (inf if beyond the last bucket)."""
+        rank, seen = q * self.count, 0
+        for bound, count in zip(self.BUCKETS + (float('inf'),), self.counts):
+            seen += count
+            if seen >= rank and seen: return bound
+        return 0.0
+
+class Metrics:
+    """Process-wide counters and latency histograms, exported in Prometheus text format.
+
+    Series are keyed by name plus a small, fixed set of label values. Updates may come from
+    worker threads (SQLite, yfinance), hence the lock.
+    """
+
+    def __init__(self):
+        self.histograms = {} # (name, labels) -> Histogram
+        self.counters = {} # (name, labels) -> float
+        self._lock = threading.Lock()
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def inc(self, name: str, amount: float = 1, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    @contextmanager
+    def track(self, name: str, **labels):
+        """Times the block into `<name>_seconds` and counts `<name>_errors_total` on exceptions or `call.error = True`.
+
+        Cancellation (e.g. the losing attempt of a hedged call) is timed but not counted as an error.
+        """
+        call = SimpleNamespace(error=False)
+        started = time.perf_counter()
+        try:
+            yield call
+        except asyncio.CancelledError:
+            raise
+        except BaseException:
+            call.error = True
+            raise
+        finally:
+            self.observe(f"{name}_seconds", time.perf_counter() - started, **labels)
+            if call.error: self.inc(f"{name}_errors_total", **labels)
+
+    def series(self, name: str) -> dict:
+        """Returns {labels dict as tuple: Histogram} for one histogram name."""
+        with self._lock:
+            return {labels: h for (n, labels), h in self.histograms.items() if n == name}
+
+    def counter_total(self, name: str, **match) -> float:
+        """Sums a counter across every label set that includes `match`."""
+        with self._lock:
+            return sum(v for (n, labels), v in self.counters.items() if n == name and match.items() <= dict(labels).items())
+
+    def render_prometheus(self, gauges: dict) -> str:
+        def fmt(labels, extra=()):
+            pairs = [f'{k}="{v}"' for k, v in tuple(labels) + tuple(extra)]
+            return "{" + ",".join(pairs) + "}" if pairs else ""
+        lines = []
+        with self._lock:
+            histograms, counters = list(self.histograms.items()), list(self.counters.items())
+        for name in sorted({n for (n, _), _ in histograms}):
+            lines.append(f"# TYPE bot_{name} histogram")
+            for (n, labels), h in histograms:
+                if n != name: continue
+                cumulative = 0
+                for bound, count in zip(Histogram.BUCKETS + ('+Inf',), h.counts):
+                    cumulative += count
+                    lines.append(f"bot_{name}_bucket{fmt(labels, [('le', bound)])} {cumulative}")
+                lines.append(f"bot_{name}_sum{fmt(labels)} {h.sum}")
+                lines.append(f"bot_{name}_count{fmt(labels)} {h.count}")
+        for name in sorted({n for (n, _), _ in counters}):
+            lines.append(f"# TYPE bot_{name} counter")
+            lines.extend(f"bot_{name}{fmt(labels)} {value}" for (n, labels), value in counters if n == name)
+        for name, value in sorted(gauges.items()):
+            lines.append(f"# TYPE bot_{name} gauge")
+            lines.append(f"bot_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
 # --- Database Setup & Helpers ---
-def db_query(query: str, params: tuple = ()):
-    conn = sqlite3.connect("bot_users.db", check_same_thread=False)
-    cursor = conn.cursor()
-    cursor.execute(query, params)
-    result = cursor.fetchall()
-    conn.commit()
-    conn.close()
-    return result
+class Database:
+    """Long-lived SQLite connections in WAL mode, used from worker threads only.
+
+    Reads run on a small pool of reader threads, each with its own connection.
+    Writes are queued and applied by a single writer thread, which commits everything
+    queued since its last commit in one transaction (group commit), so concurrent
+    handlers never contend for the write lock.
+    """
+
+    PRAGMAS = ("PRAGMA journal_mode=WAL", "PRAGMA synchronous=NORMAL", "PRAGMA busy_timeout=5000",
+               "PRAGMA temp_store=MEMORY", "PRAGMA cache_size=-16000", "PRAGMA mmap_size=67108864")
+
+    def __init__(self, path: str, readers: int = 4):
+        self.path = path
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self._reader_pool = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="sqlite-read")
+        self._writer_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-write")
+        self._write_queue = [] # (query, params, future) waiting for the next group commit
+        self._writer_task = None
+        self._deferred_users = {} # user_id -> username, flushed periodically
+        self._known_users = set()
+        self._flush_task = None
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # Autocommit mode; the writer manages its own transactions. Prepared statements are cached per connection.
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, cached_statements=256)
+            for pragma in self.PRAGMAS:
+                conn.execute(pragma)
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    def _read(self, query: str, params: tuple) -> list:
+        with metrics.track("sqlite_query", op="read"):
+            return self._connection().execute(query, params).fetchall()
+
+    def _apply_writes(self, batch: list) -> list:
+        with metrics.track("sqlite_query", op="write_batch"):
+            metrics.inc("sqlite_writes_total", len(batch))
+            return self._apply_writes_unlocked(batch)
+
+    def _apply_writes_unlocked(self, batch: list) -> list:
+        """Applies queued writes in one transaction; each runs in its own savepoint, so a failing
+        statement (or executemany) is undone as a whole and reported as its result."""
+        conn = self._connection()
+        results = []
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for query, params in batch:
+                conn.execute("SAVEPOINT queued_write")
+                try:
+                    cursor = conn.executemany(query, params) if isinstance(params, list) else conn.execute(query, params)
+                    # Statements with a RETURNING clause yield their rows, everything else its rowcount
+                    results.append(cursor.fetchall() if cursor.description else cursor.rowcount)
+                except sqlite3.Error as e:
+                    conn.execute("ROLLBACK TO queued_write")
+                    results.append(e)
+                conn.execute("RELEASE queued_write")
+            conn.execute("COMMIT")
+        except BaseException:
+            if conn.in_transaction: conn.execute("ROLLBACK")
+            raise
+        return results
+
+    def run_sync(self, query: str, params: tuple = ()) -> list:
+        """Runs a statement on the writer thread and blocks for the result (for startup/DDL only).
+
+        A list of tuples as params runs as executemany in one transaction and returns the rowcount.
+        """
+        def _run():
+            if isinstance(params, list):
+                result = self._apply_writes_unlocked([(query, params)])[0]
+                if isinstance(result, Exception): raise result
+                return result
+            return self._connection().execute(query, params).fetchall()
+        return self._writer_pool.submit(_run).result()
+
+    async def fetchall(self, query: str, params: tuple = ()) -> list:
+        return await asyncio.get_running_loop().run_in_executor(self._reader_pool, self._read, query, params)
+
+    async def execute(self, query: str, params=()) -> int:
+        """Queues a write for the next group commit and returns its rowcount (or RETURNING rows).
+
+        A list of tuples as params runs as executemany.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._write_queue.append((query, params, future))
+        if self._writer_task is None:
+            self._writer_task = asyncio.ensure_future(self._drain_writes())
+        return await future
+
+    async def _drain_writes(self) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            while self._write_queue:
+                batch, self._write_queue = self._write_queue, []
+                try:
+                    results = await loop.run_in_executor(self._writer_pool, self._apply_writes, [(q, p) for q, p, _ in batch])
+                except Exception as e:
+                    results = [e] * len(batch)
+                for (_, _, future), result in zip(batch, results):
+                    if future.done(): continue
+                    if isinstance(result, Exception): future.set_exception(result)
+                    else: future.set_result(result)
+        finally:
+            self._writer_task = None
+
+    def defer_user(self, user_id: int, username: str) -> None:
+        """Buffers a low-value `users` upsert until the next periodic flush."""
+        if user_id in self._known_users: return
+        self._deferred_users[user_id] = username
+
+    async def flush_deferred(self) -> None:
+        if not self._deferred_users: return
+        users, self._deferred_users = self._deferred_users, {}
+        await self.execute("INSERT OR IGNORE INTO users (user_id, username, first_seen) VALUES (?, ?, datetime('now'))", list(users.items()))
+        if len(self._known_users) > 100_000: self._known_users.clear()
+        self._known_users.update(users)
+
+    async def _flush_periodically(self, interval: float) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.flush_deferred()
+            except Exception as e:
+                logging.error(f"Error flushing deferred writes: {e}")
+
+    def start(self, flush_interval: float) -> None:
+        if self._flush_task is None:
+            self._flush_task = asyncio.ensure_future(self._flush_periodically(flush_interval))
+
+    async def close(self) -> None:
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush_deferred()
+        while self._writer_task is not None:
+            await self._writer_task
+        self._reader_pool.shutdown(wait=True)
+        self._writer_pool.shutdown(wait=True)
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+
+database = Database(DB_PATH, readers=DB_READ_CONNECTIONS)
+
+async def db_query(query: str, params: tuple = ()) -> list:
+    return await database.fetchall(query, params)
+
+async def db_execute(query: str, params=()):
+    return await database.execute(query, params)
 
 def setup_database():
-    db_query("CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY, username TEXT, first_seen TEXT)")
-    db_query("""
+    database.run_sync("CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY, username TEXT, first_seen TEXT)")
+    database.run_sync("""
         CREATE TABLE IF NOT EXISTS watchlist (
             watchlist_id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL,
             ticker_symbol TEXT NOT NULL, UNIQUE(user_id, ticker_symbol)
         )""")
+    # Reverse lookups (who watches X, which symbols are watched) without scanning every user's rows
+    database.run_sync("CREATE INDEX IF NOT EXISTS idx_watchlist_ticker ON watchlist (ticker_symbol, user_id)")
+    database.run_sync("CREATE TABLE IF NOT EXISTS user_state (user_id INTEGER PRIMARY KEY, state TEXT NOT NULL, updated REAL)")
+    database.run_sync("""
+        CREATE TABLE IF NOT EXISTS quiz_questions (
+            question_id INTEGER PRIMARY KEY, category TEXT NOT NULL, difficulty INTEGER NOT NULL,
+            question TEXT NOT NULL, options TEXT NOT NULL, correct INTEGER NOT NULL, explanation TEXT
+        )""")
+    database.run_sync("CREATE INDEX IF NOT EXISTS idx_quiz_questions_category ON quiz_questions (category, question_id)")
+    # Spaced repetition: one row per (user, answered question) with its Leitner box and next review time
+    database.run_sync("""
+        CREATE TABLE IF NOT EXISTS quiz_progress (
+            user_id INTEGER NOT NULL, question_id INTEGER NOT NULL, box INTEGER NOT NULL, due REAL NOT NULL,
+            PRIMARY KEY (user_id, question_id)
+        ) WITHOUT ROWID""")
+    database.run_sync("CREATE INDEX IF NOT EXISTS idx_quiz_progress_due ON quiz_progress (user_id, due)")
+    database.run_sync("CREATE TABLE IF NOT EXISTS symbols (symbol TEXT PRIMARY KEY, name TEXT, exchange TEXT)")
+    database.run_sync("""
+        CREATE TABLE IF NOT EXISTS alerts (
+            alert_id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, ticker_symbol TEXT NOT NULL,
+            kind TEXT NOT NULL, threshold REAL NOT NULL, created TEXT
+        )""")
+    database.run_sync("CREATE INDEX IF NOT EXISTS idx_alerts_user ON alerts (user_id)")
+    # Outbound notifications; broadcast rows share their text through the broadcasts table
+    database.run_sync("CREATE TABLE IF NOT EXISTS broadcasts (broadcast_id INTEGER PRIMARY KEY AUTOINCREMENT, text TEXT NOT NULL, created TEXT)")
+    database.run_sync("""
+        CREATE TABLE IF NOT EXISTS outbox (
+            message_id INTEGER PRIMARY KEY AUTOINCREMENT, chat_id INTEGER NOT NULL, text TEXT, parse_mode TEXT,
+            broadcast_id INTEGER, status TEXT NOT NULL DEFAULT 'pending', attempts INTEGER NOT NULL DEFAULT 0,
+            not_before REAL NOT NULL DEFAULT 0, updated REAL
+        )""")
+    database.run_sync("CREATE INDEX IF NOT EXISTS idx_outbox_pending ON outbox (status, not_before)")
+    database.run_sync("CREATE INDEX IF NOT EXISTS idx_outbox_broadcast ON outbox (broadcast_id, status)")
+    # Optional holdings on watchlist entries; added in place for databases created before portfolios existed
+    columns = {row[1] for row in database.run_sync("PRAGMA table_info(watchlist)")}
+    for column in ("quantity", "avg_cost"):
+        if column not in columns: database.run_sync(f"ALTER TABLE watchlist ADD COLUMN {column} REAL")
+    # When each alert last fired (epoch seconds), so cooldowns survive restarts and are shared between instances
+    if "last_triggered" not in {row[1] for row in database.run_sync("PRAGMA table_info(alerts)")}:
+        database.run_sync("ALTER TABLE alerts ADD COLUMN last_triggered REAL")
 
 def log_user(user):
-    if user: db_query("INSERT OR IGNORE INTO users (user_id, username, first_seen) VALUES (?, ?, datetime('now'))", (user.id, user.username))
+    if user: database.defer_user(user.id, user.username)
+
+class WatchlistIndex:
+    """Write-through in-memory view of the `watchlist` table.
+
+    Each user's tickers are loaded lazily from SQLite and kept in a bounded LRU. Mutations
+    write to SQLite first, then update the loaded entry. Per-user locks stop a lazy load
+    from racing a concurrent write for the same user. Reverse (ticker -> users) queries go to
+    SQLite through idx_watchlist_ticker (watchers) rather than being cached here. The set of watched
+    symbols is kept complete in memory as per-ticker watcher counts, loaded once.
+    """
+
+    def __init__(self, max_users: int):
+        self.max_users = max_users
+        self._by_user = OrderedDict() # user_id -> {ticker: None}, insertion-ordered like the table
+        self._user_locks = weakref.WeakValueDictionary()
+        self._counts = None # ticker -> number of watchers; None until first loaded
+        self._version = 0 # Bumped when a mutation starts and when it finishes
+        self._writing = 0 # Mutations currently awaiting SQLite
+
+    @staticmethod
+    def _lock(locks, key) -> asyncio.Lock:
+        lock = locks.get(key)
+        if lock is None:
+            lock = locks[key] = asyncio.Lock()
+        return lock
+
+    @staticmethod
+    def _remember(lru: OrderedDict, key, value, limit: int) -> None:
+        lru[key] = value
+        while len(lru) > limit:
+            lru.popitem(last=False)
+
+    async def _user_entry(self, user_id: int) -> dict:
+        entry = self._by_user.get(user_id)
+        if entry is None:
+            async with self._lock(self._user_locks, user_id):
+                entry = self._by_user.get(user_id)
+                if entry is None:
+                    rows = await db_query("SELECT ticker_symbol FROM watchlist WHERE user_id = ? ORDER BY watchlist_id", (user_id,))
+                    entry = dict.fromkeys(row[0] for row in rows)
+                    self._remember(self._by_user, user_id, entry, self.max_users)
+        self._by_user.move_to_end(user_id)
+        return entry
+
+    async def tickers(self, user_id: int) -> list:
+        return list(await self._user_entry(user_id))
+
+    async def contains(self, user_id: int, ticker_symbol: str) -> bool:
+        return ticker_symbol in await self._user_entry(user_id)
+
+    async def watchers(self, ticker_symbol: str) -> set:
+        """Returns the ids of every user watching ticker_symbol (an index-only search of idx_watchlist_ticker)."""
+        return {row[0] for row in await db_query("SELECT user_id FROM watchlist WHERE ticker_symbol = ?", (ticker_symbol,))}
+
+    async def watched_symbols(self) -> list:
+        """Returns every symbol on at least one watchlist; SQLite is only read until the counts are loaded."""
+        if self._counts is not None: return list(self._counts)
+        version = self._version
+        counts = dict(await db_query("SELECT ticker_symbol, COUNT(*) FROM watchlist GROUP BY ticker_symbol"))
+        # Only keep the snapshot if no mutation overlapped the read; otherwise it may miss or double-count one
+        if version == self._version and not self._writing: self._counts = counts
+        return list(counts)
+
+    async def _write(self, ticker_symbol: str, query: str, params: tuple, delta: int) -> int:
+        self._version += 1
+        self._writing += 1
+        try:
+            changed = await db_execute(query, params)
+        finally:
+            self._writing -= 1
+            self._version += 1
+        if changed > 0 and self._counts is not None:
+            count = self._counts.get(ticker_symbol, 0) + delta
+            if count > 0: self._counts[ticker_symbol] = count
+            else: self._counts.pop(ticker_symbol, None)
+        return changed
+
+    async def add(self, user_id: int, ticker_symbol: str) -> bool:
+        async with self._lock(self._user_locks, user_id):
+            changed = await self._write(ticker_symbol, "INSERT OR IGNORE INTO watchlist (user_id, ticker_symbol) VALUES (?, ?)", (user_id, ticker_symbol), 1)
+            if user_id in self._by_user: self._by_user[user_id][ticker_symbol] = None
+        return changed > 0
+
+    async def remove(self, user_id: int, ticker_symbol: str) -> bool:
+        async with self._lock(self._user_locks, user_id):
+            changed = await self._write(ticker_symbol, "DELETE FROM watchlist WHERE user_id = ? AND ticker_symbol = ?", (user_id, ticker_symbol), -1)
+            if user_id in self._by_user: self._by_user[user_id].pop(ticker_symbol, None)
+        return changed > 0
+
+    def stats(self) -> dict:
+        return {"users": len(self._by_user), "symbols": len(self._counts or ())}
+
+watchlist_index = WatchlistIndex(max_users=WATCHLIST_INDEX_MAX_USERS)
 
 async def cleanup_previous_message(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
     """Deletes the last main message sent by the bot."""
@@ -154,42 +631,1478 @@ async def cleanup_previous_message(context: ContextTypes.DEFAULT_TYPE, chat_id:
         except BadRequest as e:
             logging.warning(f"Could not delete message: {e}")
 
+# --- Per-User State Persistence ---
+class SQLitePersistence(BasePersistence):
+    """Stores `context.user_data` as one compact JSON row per user in the `user_state` table.
+
+    Nothing is loaded up front: a user's row is read the first time one of their updates is
+    processed (refresh_user_data). On each persistence run only users whose encoded state
+    changed since the last write are saved, and those writes share one group commit. Users idle
+    for longer than `idle_timeout` are written if needed and dropped from memory, so memory is
+    bounded by recently active users rather than by everyone who ever used the bot.
+    Chat data, bot data, callback data and conversations are not persisted.
+    """
+
+    def __init__(self, update_interval: float, idle_timeout: float):
+        super().__init__(store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False), update_interval=update_interval)
+        self.idle_timeout = idle_timeout
+        self._loaded = set() # user_ids whose row has been merged into the application's user_data
+        self._loading = {} # user_id -> future of the row read in flight, awaited by concurrent updates
+        self._stored = {} # user_id -> hash of the last written state
+        self._last_seen = {} # user_id -> monotonic time of their last update
+        self._evicting = set() # user_ids dropped from memory only, whose rows must survive
+        self._application = None
+        self._task = None
+        self.loads = self.writes = self.skipped = self.evicted = 0
+
+    @staticmethod
+    def _encode(data: dict):
+        try:
+            return json.dumps(data, separators=(',', ':'), sort_keys=True)
+        except (TypeError, ValueError) as e:
+            logging.error(f"user_data is not JSON-serialisable, not persisting it: {e}")
+            return None
+
+    async def get_user_data(self) -> dict:
+        return {} # Loaded lazily per user in refresh_user_data
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        """Merges the user's stored row into user_data once; concurrent updates wait for that read."""
+        self._last_seen[user_id] = time.monotonic()
+        if user_id in self._loaded: return
+        loading = self._loading.get(user_id)
+        if loading is None:
+            loading = self._loading[user_id] = asyncio.ensure_future(self._load(user_id, user_data))
+            loading.add_done_callback(lambda _: self._loading.pop(user_id, None))
+        await asyncio.shield(loading)
+
+    async def _load(self, user_id: int, user_data: dict) -> None:
+        rows = await db_query("SELECT state FROM user_state WHERE user_id = ?", (user_id,))
+        if rows:
+            self.loads += 1
+            self._stored[user_id] = hash(rows[0][0])
+            for key, value in json.loads(rows[0][0]).items():
+                user_data.setdefault(key, value)
+        self._loaded.add(user_id) # Only now, so a failed read is retried and flush never writes a half-loaded user
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        encoded = self._encode(data)
+        if encoded is None: return
+        if self._stored.get(user_id) == hash(encoded):
+            self.skipped += 1
+            return
+        self._stored[user_id] = hash(encoded)
+        self.writes += 1
+        if data:
+            await db_execute("INSERT INTO user_state (user_id, state, updated) VALUES (?, ?, ?) ON CONFLICT(user_id) DO UPDATE SET state = excluded.state, updated = excluded.updated",
+                             (user_id, encoded, time.time()))
+        else:
+            await db_execute("DELETE FROM user_state WHERE user_id = ?", (user_id,))
+
+    async def drop_user_data(self, user_id: int) -> None:
+        if user_id in self._evicting:
+            self._evicting.discard(user_id)
+            # Reloaded by a new update before this drop ran: the application skips updating a user it is
+            # dropping in the same run, so write their fresh state here instead
+            data = self._application.user_data.get(user_id) if user_id in self._loaded else None
+            if data is not None: await self.update_user_data(user_id, data)
+            return
+        self._stored.pop(user_id, None)
+        await db_execute("DELETE FROM user_state WHERE user_id = ?", (user_id,))
+
+    async def evict_idle(self, application: Application) -> int:
+        """Persists and forgets the in-memory state of users idle for longer than idle_timeout."""
+        cutoff = time.monotonic() - self.idle_timeout
+        idle = [user_id for user_id, seen in self._last_seen.items() if seen < cutoff]
+        for user_id in idle:
+            data = application.user_data.get(user_id)
+            if data is not None: await self.update_user_data(user_id, data)
+            if self._last_seen.get(user_id, 0) >= cutoff: continue # Active again while being written
+            del self._last_seen[user_id]
+            self._loaded.discard(user_id); self._stored.pop(user_id, None)
+            if data is not None:
+                self._evicting.add(user_id)
+                application.drop_user_data(user_id)
+        self.evicted += len(idle)
+        return len(idle)
+
+    async def _evict_periodically(self, application: Application) -> None:
+        while True:
+            await asyncio.sleep(min(60, self.idle_timeout))
+            try:
+                await self.evict_idle(application)
+            except Exception as e:
+                logging.error(f"Error evicting idle user state: {e}")
+
+    def start(self, application: Application) -> None:
+        self._application = application
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._evict_periodically(application))
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def flush(self) -> None:
+        """Writes every resident user whose state differs from their stored row (called on shutdown)."""
+        if self._application is None: return
+        resident = [(user_id, data) for user_id in self._loaded if (data := self._application.user_data.get(user_id)) is not None]
+        await asyncio.gather(*(self.update_user_data(user_id, data) for user_id, data in resident))
+
+    def stats(self) -> dict:
+        return {"resident": len(self._last_seen), "loads": self.loads, "writes": self.writes, "skipped": self.skipped, "evicted": self.evicted}
+
+    # Only user_data is persisted
+    async def get_chat_data(self) -> dict: return {}
+    async def get_bot_data(self) -> dict: return {}
+    async def get_callback_data(self): return None
+    async def get_conversations(self, name: str) -> dict: return {}
+    async def update_chat_data(self, chat_id: int, data: dict) -> None: pass
+    async def update_bot_data(self, data: dict) -> None: pass
+    async def update_callback_data(self, data) -> None: pass
+    async def update_conversation(self, name: str, key: tuple, new_state) -> None: pass
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None: pass
+    async def refresh_bot_data(self, bot_data: dict) -> None: pass
+    async def drop_chat_data(self, chat_id: int) -> None: pass
+
+user_state = SQLitePersistence(USER_STATE_FLUSH_INTERVAL, USER_STATE_IDLE_TIMEOUT)
+
+# --- Quote Cache ---
+class QuoteCache:
+    """In-process LRU cache of Yahoo quote dicts with a freshness TTL.
+
+    Concurrent misses for the same symbol share one in-flight fetch, so a hot
+    ticker costs a single upstream call per TTL window no matter how many users tap it.
+    `ttl` is either seconds or a callable returning the TTL for a given symbol.
+
+    Entries up to `stale_ttl` seconds past their TTL are served immediately while a refresh
+    runs in the background (stale-while-revalidate), and when a refresh fails the last known
+    entry of any age is returned instead of the error. Use `age()` to tell callers how old it is.
+
+    Each entry records whether it came from the full loader or only from batch downloads, so
+    callers that need the full quote (`get(full=True)`) can tell the two apart. A symbol the
+    upstream reports as not found is cached as an empty full entry for the TTL like any other.
+    """
+
+    def __init__(self, loader, batch_loader, ttl, max_entries: int, stale_ttl: float = 0):
+        self._loader = loader
+        self._batch_loader = batch_loader
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict() # symbol -> (fetched_at, info, full)
+        self._inflight = {} # symbol -> asyncio.Future
+        self._partial = set() # symbols whose in-flight fetch is a batch download (price fields only)
+        self.hits = self.misses = self.coalesced = self.stale = self.fallbacks = 0
+        self.listeners = [] # callables(symbol, info) notified of every stored quote
+
+    def ttl_for(self, symbol: str) -> float:
+        return self.ttl(symbol) if callable(self.ttl) else self.ttl
+
+    def age(self, symbol: str):
+        """Seconds since the cached entry was fetched, or None if there is none."""
+        entry = self._entries.get(symbol)
+        return None if entry is None else time.monotonic() - entry[0]
+
+    def peek(self, symbol: str, max_age: float = None):
+        """Returns the cached quote if it is younger than max_age (default: the TTL), else None."""
+        entry = self._entries.get(symbol)
+        if entry is None: return None
+        fetched_at, info, _ = entry
+        if max_age is None: max_age = self.ttl_for(symbol)
+        if time.monotonic() - fetched_at > max_age: return None
+        self._entries.move_to_end(symbol)
+        return info
+
+    def _is_full(self, symbol: str) -> bool:
+        entry = self._entries.get(symbol)
+        return entry is not None and entry[2]
+
+    def _peek_stale(self, symbol: str, full: bool = False):
+        if not self.stale_ttl or (full and not self._is_full(symbol)): return None
+        return self.peek(symbol, max_age=self.ttl_for(symbol) + self.stale_ttl)
+
+    def _last_known(self, symbol: str, full: bool = False):
+        entry = self._entries.get(symbol)
+        if entry is None or (full and not entry[2]): return None
+        self.fallbacks += 1
+        return entry[1]
+
+    def put(self, symbol: str, info: dict, merge: bool = False, full: bool = True) -> None:
+        """Stores a quote; full=False marks a partial one (batch download fields only).
+
+        With merge=True, fields missing from info (e.g. longName) and fullness are kept from the old entry.
+        """
+        if merge and symbol in self._entries:
+            _, old, was_full = self._entries[symbol]
+            info, full = {**old, **info}, full or was_full
+        self._entries[symbol] = (time.monotonic(), info, full)
+        self._entries.move_to_end(symbol)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        for listener in self.listeners:
+            try:
+                listener(symbol, info)
+            except Exception as e:
+                logging.error(f"Error in quote listener: {e}")
+
+    async def get(self, symbol: str, full: bool = False) -> dict:
+        """Returns a fresh quote; with full=True, entries only ever filled by batch downloads count as misses."""
+        info = self.peek(symbol)
+        if info is not None and (not full or self._is_full(symbol)):
+            self.hits += 1
+            return info
+        task = self._inflight.get(symbol)
+        if task is not None and full and symbol in self._partial and not self._is_full(symbol):
+            task = None # A batch download won't bring the full quote; fetch it alongside
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            task = asyncio.ensure_future(self._fetch(symbol))
+            task.add_done_callback(lambda t: t.cancelled() or t.exception()) # Nobody may await a background revalidation
+            self._inflight[symbol] = task
+            self._partial.discard(symbol)
+        stale = self._peek_stale(symbol, full)
+        if stale is not None:
+            self.stale += 1
+            return stale
+        try:
+            # Shield so one impatient caller being cancelled doesn't cancel the fetch for everyone else
+            return await asyncio.shield(task)
+        except Exception as e:
+            info = self._last_known(symbol, full)
+            if info is None: raise
+            logging.warning(f"Serving last known value for {symbol} after refresh failed: {e}")
+            return info
+
+    async def get_many(self, symbols: list) -> dict:
+        """Returns {symbol: info or Exception}, fetching all misses in a single batch request.
+
+        Stale entries are returned as-is and revalidated by the same batch in the background.
+        """
+        results, waiting, missing = {}, {}, []
+        for symbol in dict.fromkeys(symbols):
+            info = self.peek(symbol)
+            if info is not None:
+                self.hits += 1
+                results[symbol] = info
+            elif (info := self._peek_stale(symbol)) is not None:
+                self.stale += 1
+                results[symbol] = info
+                if symbol not in self._inflight: missing.append(symbol)
+            elif symbol in self._inflight:
+                self.coalesced += 1
+                waiting[symbol] = self._inflight[symbol]
+            else:
+                self.misses += 1
+                missing.append(symbol)
+        if missing:
+            loop = asyncio.get_running_loop()
+            futures = {symbol: loop.create_future() for symbol in missing}
+            self._inflight.update(futures)
+            self._partial.update(futures)
+            asyncio.ensure_future(self._fetch_batch(futures))
+            waiting.update((symbol, f) for symbol, f in futures.items() if symbol not in results)
+        if waiting:
+            fetched = await asyncio.gather(*(asyncio.shield(f) for f in waiting.values()), return_exceptions=True)
+            for symbol, info in zip(waiting, fetched):
+                if isinstance(info, Exception): info = self._last_known(symbol) or info
+                results[symbol] = info
+        return results
+
+    async def _load(self, symbol: str):
+        try:
+            return await self._loader(symbol)
+        except Exception as e:
+            if not is_not_found(e): raise
+            return {} # Cached for the TTL, so lookups of an unknown symbol don't all go upstream
+
+    async def _fetch(self, symbol: str) -> dict:
+        try:
+            info = await self._load(symbol)
+            self.put(symbol, info)
+            return info
+        finally:
+            if self._inflight.get(symbol) is asyncio.current_task(): del self._inflight[symbol]
+
+    async def _fetch_batch(self, futures: dict) -> None:
+        symbols = list(futures)
+        try:
+            quotes = await self._batch_loader(symbols)
+        except Exception as e:
+            if len(symbols) > 1:
+                # Fanning a failed batch out into per-symbol requests would multiply the load on a struggling upstream
+                logging.warning(f"Batch quote fetch of {len(symbols)} symbols failed: {e}")
+                quotes = dict.fromkeys(symbols, e)
+            else:
+                quotes = {}
+        for symbol, info in quotes.items():
+            if symbol in futures and not isinstance(info, Exception):
+                self.put(symbol, info, merge=True, full=False)
+        # Anything a successful bulk download couldn't resolve is fetched individually
+        leftovers = [s for s in symbols if s not in quotes]
+        fallback = await asyncio.gather(*(self._load(s) for s in leftovers), return_exceptions=True)
+        for symbol, info in zip(leftovers, fallback):
+            if not isinstance(info, Exception):
+                self.put(symbol, info)
+            quotes[symbol] = info
+        for symbol, future in futures.items():
+            if self._inflight.get(symbol) is future:
+                del self._inflight[symbol]
+                self._partial.discard(symbol)
+            if future.done(): continue
+            if isinstance(quotes[symbol], Exception):
+                future.set_exception(quotes[symbol])
+                future.exception() # Mark retrieved; callers see it through gather(return_exceptions=True)
+            else:
+                future.set_result(self.peek(symbol, max_age=float('inf')))
+
+    def stats(self) -> dict:
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses, "coalesced": self.coalesced,
+                "stale": self.stale, "fallbacks": self.fallbacks, "inflight": len(self._inflight)}
+
+# --- Upstream Clients ---
+class AsyncRateLimiter:
+    """Token bucket shared by every upstream caller on the event loop."""
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = self.max_rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+
+    async def acquire(self) -> None:
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def slow_down(self) -> None:
+        """Halves the rate after a rate-limited reply (down to 1/16 of the configured rate)."""
+        self.rate = max(self.max_rate / 16, self.rate / 2)
+
+    def speed_up(self) -> None:
+        """Recovers 5% of the configured rate per successful call."""
+        self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+class UpstreamUnavailable(Exception):
+    """Raised instead of calling an upstream whose circuit breaker is open."""
+
+    def __init__(self, name: str, retry_in: float):
+        super().__init__(f"{name} is unavailable, retrying in {retry_in:.0f}s")
+        self.retry_in = retry_in
+
+def is_rate_limited(error: Exception) -> bool:
+    if isinstance(error, httpx.HTTPStatusError): return error.response.status_code == 429
+    return type(error).__name__ == 'YFRateLimitError' or 'Too Many Requests' in str(error)
+
+def is_not_found(error: Exception) -> bool:
+    """Whether the upstream answered that the symbol doesn't exist (HTTP 404 from httpx, requests or curl_cffi)."""
+    return getattr(getattr(error, 'response', None), 'status_code', None) == 404
+
+def is_upstream_failure(error: Exception) -> bool:
+    """Whether an error says something about upstream health (as opposed to e.g. an unknown ticker)."""
+    if isinstance(error, httpx.HTTPStatusError): return error.response.status_code == 429 or error.response.status_code >= 500
+    return not is_not_found(error) and not isinstance(error, (KeyError, ValueError, TypeError, IndexError))
+
+class CircuitBreaker:
+    """Stops calling a struggling upstream and probes it again after a cool-off.
+
+    closed -> open after `failure_threshold` consecutive failures, or a single rate-limited reply;
+    open -> half_open once the cool-off elapses, letting exactly one probe through, whose outcome
+    closes or re-opens the circuit. Each consecutive opening doubles the cool-off (with jitter) up
+    to `max_reset_timeout`. Rate-limited replies also slow down the shared `limiter`.
+    """
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float, max_reset_timeout: float, limiter: AsyncRateLimiter = None):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.limiter = limiter
+        self.state = "closed"
+        self.failures = 0
+        self.openings = 0 # Consecutive openings; drives the backoff
+        self.opened_until = 0.0
+        self._probing = False
+
+    def _transition(self, state: str) -> None:
+        if state == self.state: return
+        logging.warning(f"Circuit '{self.name}': {self.state} -> {state}")
+        metrics.inc("circuit_transitions_total", breaker=self.name, state=state)
+        self.state = state
+
+    def retry_in(self) -> float:
+        return max(0.0, self.opened_until - time.monotonic()) if self.state == "open" else 0.0
+
+    def allow(self) -> None:
+        if self.state == "open":
+            if self.retry_in() > 0: raise UpstreamUnavailable(self.name, self.retry_in())
+            self._transition("half_open")
+        if self.state == "half_open":
+            if self._probing: raise UpstreamUnavailable(self.name, self.reset_timeout)
+            self._probing = True
+
+    def record_success(self) -> None:
+        self._probing = False
+        self.failures = self.openings = 0
+        if self.limiter: self.limiter.speed_up()
+        self._transition("closed")
+
+    def record_failure(self, error: Exception) -> None:
+        self._probing = False
+        if self.state == "open": return # A call started before the circuit opened
+        rate_limited = is_rate_limited(error)
+        if rate_limited and self.limiter: self.limiter.slow_down()
+        self.failures += 1
+        if self.state == "half_open" or rate_limited or self.failures >= self.failure_threshold:
+            cool_off = min(self.max_reset_timeout, self.reset_timeout * 2 ** self.openings) * random.uniform(0.8, 1.2)
+            self.openings += 1
+            self.opened_until = time.monotonic() + cool_off
+            self._transition("open")
+
+    async def call(self, factory):
+        """Awaits factory() if the circuit allows it and records the outcome."""
+        self.allow()
+        try:
+            result = await factory()
+        except Exception as e:
+            if is_upstream_failure(e): self.record_failure(e)
+            else: self._probing = False # The upstream answered; the request itself was bad
+            raise
+        except BaseException:
+            self._probing = False
+            raise
+        self.record_success()
+        return result
+
+async def hedged(factory, delay: float):
+    """Awaits factory(), starting a second attempt if the first hasn't finished within `delay`.
+
+    The first attempt to succeed wins and the other is cancelled; if both fail, the last error is raised.
+    """
+    attempts = {asyncio.ensure_future(factory())}
+    try:
+        done, _ = await asyncio.wait(attempts, timeout=delay)
+        if not done:
+            metrics.inc("upstream_hedges_total")
+            attempts.add(asyncio.ensure_future(factory()))
+        error = None
+        while attempts:
+            done, attempts = await asyncio.wait(attempts, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None: return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        for task in attempts: task.cancel()
+
+async def call_upstream(breaker: CircuitBreaker, factory, hedge_delay: float = 0):
+    """Runs factory() through the circuit breaker, hedging it only while the circuit is healthy."""
+    if hedge_delay and breaker.state == "closed":
+        return await breaker.call(lambda: hedged(factory, hedge_delay))
+    return await breaker.call(factory)
+
+yahoo_rate_limiter = AsyncRateLimiter(YAHOO_MAX_REQUESTS_PER_SECOND, burst=max(1, int(YAHOO_MAX_REQUESTS_PER_SECOND)))
+upstream_semaphore = asyncio.Semaphore(UPSTREAM_CONCURRENCY)
+yahoo_quote_breaker = CircuitBreaker("yahoo_quotes", CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT, CIRCUIT_MAX_RESET_TIMEOUT, yahoo_rate_limiter)
+yahoo_search_breaker = CircuitBreaker("yahoo_search", CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT, CIRCUIT_MAX_RESET_TIMEOUT, yahoo_rate_limiter)
+# yfinance is synchronous; its calls run here so they never block the event loop
+yfinance_executor = ThreadPoolExecutor(max_workers=UPSTREAM_CONCURRENCY, thread_name_prefix="yfinance")
+_http_client = None
+
+def get_http_client() -> httpx.AsyncClient:
+    """Returns the shared keep-alive client used for all direct Yahoo HTTP calls."""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            headers={'User-Agent': 'Mozilla/5.0'}, timeout=UPSTREAM_TIMEOUT,
+            limits=httpx.Limits(max_connections=UPSTREAM_CONCURRENCY, max_keepalive_connections=UPSTREAM_CONCURRENCY),
+        )
+    return _http_client
+
+async def close_upstream_clients() -> None:
+    if _http_client is not None:
+        await _http_client.aclose()
+    yfinance_executor.shutdown(wait=False, cancel_futures=True)
+
+async def run_blocking(func, *args, timeout: float = UPSTREAM_TIMEOUT, op: str = "call", **kwargs):
+    """Runs a blocking upstream call on the yfinance pool under the concurrency cap and a timeout.
+
+    This keeps the event loop free, but other users' updates only proceed meanwhile when updates
+    are processed concurrently (CONCURRENT_UPDATES > 1); sequentially, a slow quote still delays them.
+    A pool thread can't be cancelled, so its concurrency slot is only released once the thread has
+    actually finished, even if the caller timed out or was cancelled long before. The timeout also
+    covers waiting for a slot, so calls don't pile up behind threads stuck on a hung upstream.
+    """
+    def finished(future: asyncio.Future) -> None:
+        upstream_semaphore.release()
+        if not future.cancelled(): future.exception() # Retrieved even when the caller has given up
+
+    loop = asyncio.get_running_loop()
+    async with asyncio.timeout(timeout):
+        await upstream_semaphore.acquire()
+        try:
+            await yahoo_rate_limiter.acquire()
+            future = loop.run_in_executor(yfinance_executor, partial(func, *args, **kwargs))
+        except BaseException:
+            upstream_semaphore.release()
+            raise
+        future.add_done_callback(finished)
+        with metrics.track("upstream", upstream="yfinance", op=op):
+            return await asyncio.shield(future) # Cancelling the caller must not mark the still-running call done
+
+async def _yahoo_search_once(search_term: str) -> list:
+    async with upstream_semaphore:
+        await yahoo_rate_limiter.acquire()
+        with metrics.track("upstream", upstream="yahoo_search", op="search"):
+            response = await get_http_client().get("https://query1.finance.yahoo.com/v1/finance/search", params={'q': search_term})
+            response.raise_for_status()
+    return response.json().get('quotes', [])
+
+async def yahoo_search(search_term: str) -> list:
+    """Queries Yahoo's symbol search and returns the raw quote dicts."""
+    return await call_upstream(yahoo_search_breaker, lambda: _yahoo_search_once(search_term), hedge_delay=UPSTREAM_HEDGE_DELAY)
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest that records latency and errors of every Bot API call by method name."""
+
+    async def do_request(self, url: str, method: str, request_data=None, **kwargs) -> tuple:
+        with metrics.track("upstream", upstream="telegram", op=url.rsplit('/', 1)[-1]) as call:
+            code, payload = await super().do_request(url, method, request_data=request_data, **kwargs)
+            call.error = code >= 400
+        return code, payload
+
+def guess_currency(ticker_symbol: str) -> str:
+    """Best-effort currency for quotes that come without metadata (bulk downloads)."""
+    if ticker_symbol.endswith(('.NS', '.BO')): return 'INR'
+    return 'USD' if '.' not in ticker_symbol and '=' not in ticker_symbol else ''
+
+async def fetch_quote_info(ticker_symbol: str) -> dict:
+    # Not hedged: the losing attempt's thread can't be cancelled and would still send its request
+    return await call_upstream(yahoo_quote_breaker, lambda: run_blocking(lambda: yf.Ticker(ticker_symbol).info, op="info"))
+
+async def fetch_quotes_batch(ticker_symbols: list) -> dict:
+    """Fetches price fields for many symbols with one multi-symbol yfinance download."""
+    async def download():
+        data = await run_blocking(yf.download, ticker_symbols, op="download", period="5d", interval="1d", group_by="ticker",
+                                  auto_adjust=False, progress=False, threads=True)
+        # yfinance logs and swallows request errors, returning an empty frame; count that against the breaker
+        # (a single unknown symbol legitimately comes back empty too, so only multi-symbol downloads qualify)
+        if data.empty and len(ticker_symbols) > 1: raise ConnectionError(f"Download of {len(ticker_symbols)} symbols returned no data")
+        return data
+    data = await call_upstream(yahoo_quote_breaker, download)
+    quotes = {}
+    for ticker in ticker_symbols:
+        try:
+            closes = data[ticker]["Close"].dropna()
+        except KeyError:
+            continue
+        if closes.empty: continue
+        price = float(closes.iloc[-1]); previous_close = float(closes.iloc[-2]) if len(closes) > 1 else price
+        change = price - previous_close
+        quotes[ticker] = {
+            'regularMarketPrice': price, 'regularMarketChange': change, 'regularMarketPreviousClose': previous_close,
+            'regularMarketChangePercent': change / previous_close if previous_close else 0,
+        }
+        # Left out when unknown, so a merge keeps the currency from an earlier full quote
+        if currency := guess_currency(ticker): quotes[ticker]['currency'] = currency
+    return quotes
+
+@cache
+def history_dtype() -> np.dtype:
+    return np.dtype([('date', 'datetime64[D]'), ('open', 'f8'), ('high', 'f8'), ('low', 'f8'), ('close', 'f8'), ('volume', 'f8')])
+
+async def fetch_history(ticker_symbol: str, start, end) -> np.ndarray:
+    """Fetches daily OHLCV bars for sessions in [start, end) as a history_dtype() array."""
+    frame = await call_upstream(yahoo_quote_breaker, lambda: run_blocking(
+        lambda: yf.Ticker(ticker_symbol).history(start=str(start), end=str(end), interval="1d", auto_adjust=False), op="history"))
+    if frame.empty: return np.empty(0, dtype=history_dtype())
+    frame = frame.dropna(subset=['Close'])
+    bars = np.empty(len(frame), dtype=history_dtype())
+    bars['date'] = frame.index.strftime('%Y-%m-%d').values.astype('datetime64[D]') # Exchange-local session dates
+    for field in ('Open', 'High', 'Low', 'Close', 'Volume'):
+        bars[field.lower()] = frame[field].to_numpy(dtype='f8')
+    return bars
+
+# --- Market Hours & Background Refresh ---
+MARKET_SESSIONS = { # market -> (timezone, open, close); exchange holidays are not modelled
+    'NSE': (ZoneInfo("Asia/Kolkata"), dt_time(9, 15), dt_time(15, 30)),
+    'NYSE': (ZoneInfo("America/New_York"), dt_time(9, 30), dt_time(16, 0)),
+}
+_market_state = {} # market -> (checked_at, is_open)
+
+def market_for(ticker_symbol: str) -> str:
+    if ticker_symbol.endswith(('.NS', '.BO')) or ticker_symbol in ('^NSEI', '^BSESN', '^NSEBANK'): return 'NSE'
+    if ticker_symbol.endswith(('-USD', '=X')): return '24x7'
+    return 'NYSE'
+
+def is_market_open(market: str) -> bool:
+    if market not in MARKET_SESSIONS: return True
+    checked_at, is_open = _market_state.get(market, (0, False))
+    if time.monotonic() - checked_at > 30:
+        tz, opens, closes = MARKET_SESSIONS[market]
+        now = datetime.now(tz)
+        is_open = now.weekday() < 5 and opens <= now.time() < closes
+        _market_state[market] = (time.monotonic(), is_open)
+    return is_open
+
+def quote_ttl(ticker_symbol: str) -> float:
+    """Quotes of closed markets don't move, so they stay fresh until the next slow refresh."""
+    return QUOTE_CACHE_TTL if is_market_open(market_for(ticker_symbol)) else CLOSED_MARKET_QUOTE_TTL
+
+def refresh_interval(ticker_symbol: str) -> float:
+    return QUOTE_REFRESH_INTERVAL if is_market_open(market_for(ticker_symbol)) else CLOSED_MARKET_REFRESH_INTERVAL
+
+quote_cache = QuoteCache(fetch_quote_info, fetch_quotes_batch, ttl=quote_ttl, max_entries=QUOTE_CACHE_MAX_ENTRIES, stale_ttl=STALE_QUOTE_MAX_AGE)
+
+class QuoteRefresher:
+    """Background task that keeps the quote cache warm for every watched symbol.
+
+    Each pass collects the de-duplicated symbols from all sources, picks the ones whose
+    market-hours-dependent refresh interval has elapsed, and refreshes them in batches,
+    so user-facing watchlist views are served from the cache.
+    """
+
+    def __init__(self, cache: QuoteCache, batch_size: int, tick: float):
+        self.cache = cache
+        self.batch_size = batch_size
+        self.tick = tick
+        self.sources = [] # async callables returning iterables of symbols
+        self._next_due = {} # symbol -> monotonic time of its next refresh
+        self._task = None
+        self.passes = self.refreshed = 0
+
+    async def symbols(self) -> set:
+        symbols = set()
+        for source in self.sources:
+            symbols.update(await source())
+        return symbols
+
+    async def refresh_once(self) -> int:
+        if yahoo_quote_breaker.retry_in() > 0: return 0 # Don't queue up work against an open circuit
+        symbols = await self.symbols()
+        now = time.monotonic()
+        due = sorted(s for s in symbols if self._next_due.get(s, 0) <= now)
+        for i in range(0, len(due), self.batch_size):
+            batch = due[i:i + self.batch_size]
+            for symbol in batch: # Failed symbols also wait a full interval rather than being retried every tick
+                self._next_due[symbol] = now + refresh_interval(symbol)
+            try:
+                quotes = await fetch_quotes_batch(batch)
+            except Exception as e:
+                logging.warning(f"Background refresh of {len(batch)} symbols failed: {e}")
+                continue
+            for symbol, info in quotes.items():
+                self.cache.put(symbol, info, merge=True, full=False)
+            self.refreshed += len(quotes)
+        for symbol in set(self._next_due) - symbols:
+            del self._next_due[symbol]
+        self.passes += 1
+        return len(due)
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.refresh_once()
+            except Exception as e:
+                logging.error(f"Error in quote refresher: {e}")
+            await asyncio.sleep(self.tick)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+quote_refresher = QuoteRefresher(quote_cache, batch_size=QUOTE_REFRESH_BATCH_SIZE, tick=QUOTE_REFRESH_TICK)
+quote_refresher.sources.append(watchlist_index.watched_symbols)
+
+# --- Outbound Delivery ---
+class DeliveryQueue:
+    """Persistent outbox for pushed messages (alerts, broadcasts), drained at Telegram's limits.
+
+    Messages are rows in the `outbox` table, so anything unsent survives a restart. A dispatcher
+    hands due rows to a fixed pool of workers, never two for the same chat at once; sends share a
+    global token bucket and each chat waits OUTBOX_PER_CHAT_INTERVAL between messages. A flood-wait
+    (RetryAfter) pauses every worker for the requested time and halves the send rate, which then
+    recovers gradually. Blocked or deleted chats fail at once; other errors retry with backoff.
+    Delivery is at-least-once: a crash between sending and recording it resends that message.
+    """
+
+    RETENTION = 7 * 86400 # Seconds sent/failed rows are kept for broadcast progress
+
+    def __init__(self, workers: int, rate: float, per_chat_interval: float, max_attempts: int):
+        self.workers = workers
+        self.limiter = AsyncRateLimiter(rate, burst=max(1, int(rate)))
+        self.per_chat_interval = per_chat_interval
+        self.max_attempts = max_attempts
+        self.bot = None
+        self._jobs = asyncio.Queue(maxsize=workers * 2)
+        self._wake = asyncio.Event()
+        self._claimed = set() # message_ids handed to workers
+        self._busy_chats = set()
+        self._chat_next = {} # chat_id -> wall time of its next allowed send
+        self._paused_until = 0.0
+        self._tasks = []
+        self.sent = self.failed = self.retried = self.flood_waits = 0
+
+    async def enqueue_many(self, messages: list, parse_mode: str = None) -> None:
+        """Queues [(chat_id, text), ...]."""
+        if not messages: return
+        await db_execute("INSERT INTO outbox (chat_id, text, parse_mode) VALUES (?, ?, ?)", [(chat_id, text, parse_mode) for chat_id, text in messages])
+        self._wake.set()
+
+    async def broadcast(self, text: str) -> tuple:
+        """Queues text for every known user; returns (broadcast_id, recipients)."""
+        rows = await db_execute("INSERT INTO broadcasts (text, created) VALUES (?, ?) RETURNING broadcast_id", (text, datetime.now().isoformat()))
+        broadcast_id = rows[0][0]
+        recipients = await db_execute("INSERT INTO outbox (chat_id, broadcast_id) SELECT user_id, ? FROM users ORDER BY user_id", (broadcast_id,))
+        self._wake.set()
+        return broadcast_id, recipients
+
+    async def progress(self, broadcast_id: int) -> dict:
+        rows = await db_query("SELECT status, COUNT(*) FROM outbox WHERE broadcast_id = ? GROUP BY status", (broadcast_id,))
+        return {'pending': 0, 'sent': 0, 'failed': 0, **dict(rows)}
+
+    async def _dispatch(self) -> None:
+        while True:
+            now = time.time()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            self._wake.clear()
+            rows = await db_query(
+                "SELECT o.message_id, o.chat_id, COALESCE(o.text, b.text), o.parse_mode, o.attempts FROM outbox o "
+                "LEFT JOIN broadcasts b ON b.broadcast_id = o.broadcast_id WHERE o.status = 'pending' AND o.not_before <= ? "
+                "ORDER BY o.message_id LIMIT ?", (now, self.workers * 4 + len(self._claimed)))
+            handed = 0
+            for row in rows:
+                message_id, chat_id = row[0], row[1]
+                if message_id in self._claimed or chat_id in self._busy_chats or self._chat_next.get(chat_id, 0) > now: continue
+                self._claimed.add(message_id); self._busy_chats.add(chat_id)
+                await self._jobs.put(row) # Blocks while every worker is busy
+                handed += 1
+            if len(self._chat_next) > 10000:
+                self._chat_next = {c: t for c, t in self._chat_next.items() if t > now}
+            if not handed:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=1)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _work(self) -> None:
+        while True:
+            message_id, chat_id, text, parse_mode, attempts = await self._jobs.get()
+            try:
+                await self._deliver(message_id, chat_id, text, parse_mode, attempts)
+            except Exception as e:
+                logging.error(f"Error delivering outbox message {message_id}: {e}")
+            finally:
+                self._claimed.discard(message_id); self._busy_chats.discard(chat_id)
+                self._wake.set()
+
+    async def _deliver(self, message_id: int, chat_id: int, text: str, parse_mode: str, attempts: int) -> None:
+        while (delay := self._paused_until - time.time()) > 0:
+            await asyncio.sleep(delay)
+        await self.limiter.acquire()
+        self._chat_next[chat_id] = time.time() + self.per_chat_interval
+        try:
+            await self.bot.send_message(chat_id=chat_id, text=text, parse_mode=parse_mode)
+        except RetryAfter as e:
+            retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else float(e.retry_after)
+            logging.warning(f"Flood control: pausing deliveries for {retry_after:.0f}s")
+            self._paused_until = max(self._paused_until, time.time() + retry_after)
+            self.limiter.slow_down()
+            self.flood_waits += 1
+            await db_execute("UPDATE outbox SET not_before = ? WHERE message_id = ?", (self._paused_until, message_id))
+            return
+        except (Forbidden, BadRequest) as e: # Bot blocked, chat gone or unsendable text: retrying can't help
+            self.failed += 1
+            await db_execute("UPDATE outbox SET status = 'failed', attempts = ?, updated = ? WHERE message_id = ?", (attempts + 1, time.time(), message_id))
+            logging.info(f"Dropping outbox message {message_id} for {chat_id}: {e}")
+            return
+        except Exception as e:
+            attempts += 1
+            status = 'failed' if attempts >= self.max_attempts else 'pending'
+            self.failed += status == 'failed'; self.retried += status == 'pending'
+            await db_execute("UPDATE outbox SET status = ?, attempts = ?, not_before = ?, updated = ? WHERE message_id = ?",
+                             (status, attempts, time.time() + min(300, 2 ** attempts), time.time(), message_id))
+            logging.warning(f"Delivery to {chat_id} failed (attempt {attempts}): {e}")
+            return
+        self.limiter.speed_up()
+        self.sent += 1
+        await db_execute("UPDATE outbox SET status = 'sent', updated = ? WHERE message_id = ?", (time.time(), message_id))
+
+    async def start(self, bot) -> None:
+        self.bot = bot
+        await db_execute("DELETE FROM outbox WHERE status != 'pending' AND updated < ?", (time.time() - self.RETENTION,))
+        self._tasks = [asyncio.ensure_future(self._dispatch())] + [asyncio.ensure_future(self._work()) for _ in range(self.workers)]
+
+    async def stop(self) -> None:
+        for task in self._tasks: task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def stats(self) -> dict:
+        return {"sent": self.sent, "failed": self.failed, "retried": self.retried, "flood_waits": self.flood_waits,
+                "in_flight": len(self._claimed), "rate": self.limiter.rate}
+
+delivery_queue = DeliveryQueue(OUTBOX_WORKERS, OUTBOX_MESSAGES_PER_SECOND, OUTBOX_PER_CHAT_INTERVAL, OUTBOX_MAX_ATTEMPTS)
+
+# --- Price Alerts ---
+class AlertBook:
+    """In-memory price alert rules, grouped by ticker and kind into sorted NumPy arrays.
+
+    'above' and 'below' compare the price, 'move' compares the absolute daily % change.
+    For a new quote, `searchsorted` finds the boundary of the triggered rules, so a tick
+    costs O(log n + k) for k triggered rules. Per-rule cooldowns (wall-clock, seeded from
+    alerts.last_triggered) live in a parallel array and are checked with one vectorised mask. Loaded rules are only turned into arrays when
+    their ticker is first quoted or edited, so loading them at startup doesn't import NumPy.
+    """
+
+    KINDS = ('above', 'below', 'move')
+
+    def __init__(self, cooldown: float):
+        self.cooldown = cooldown
+        self._rules = {} # ticker -> {alert_id: (user_id, kind, threshold)}
+        self._books = {} # (ticker, kind) -> (thresholds, alert_ids, user_ids, next_eligible)
+        self._pending = {} # (ticker, kind) -> [(threshold, alert_id, user_id, next_eligible), ...] loaded but not yet built
+        self.on_trigger = None # callable(ticker, info, [(user_id, alert_id, kind, threshold), ...])
+        self.evaluations = self.triggered = 0
+
+    def load(self, rows) -> None:
+        """Replaces all rules with (alert_id, user_id, ticker, kind, threshold, last_triggered) rows."""
+        self._rules, self._books, self._pending = {}, {}, {}
+        for alert_id, user_id, ticker, kind, threshold, last_triggered in rows:
+            self._rules.setdefault(ticker, {})[alert_id] = (user_id, kind, threshold)
+            next_eligible = last_triggered + self.cooldown if last_triggered else 0.0
+            self._pending.setdefault((ticker, kind), []).append((threshold, alert_id, user_id, next_eligible))
+
+    def _book(self, key: tuple):
+        items = self._pending.pop(key, None)
+        if items is not None:
+            thresholds, alert_ids, user_ids, next_eligible = (np.array(column) for column in zip(*items))
+            order = np.argsort(thresholds, kind='stable')
+            self._books[key] = (thresholds[order].astype(np.float64), alert_ids[order].astype(np.int64),
+                                user_ids[order].astype(np.int64), next_eligible[order].astype(np.float64))
+        return self._books.get(key)
+
+    def add(self, alert_id: int, user_id: int, ticker: str, kind: str, threshold: float) -> None:
+        self._rules.setdefault(ticker, {})[alert_id] = (user_id, kind, threshold)
+        book = self._book((ticker, kind))
+        if book is None:
+            self._books[(ticker, kind)] = (np.array([threshold], dtype=np.float64), np.array([alert_id], dtype=np.int64),
+                                           np.array([user_id], dtype=np.int64), np.zeros(1))
+            return
+        pos = int(np.searchsorted(book[0], threshold, side='right'))
+        self._books[(ticker, kind)] = tuple(np.insert(column, pos, value) for column, value in zip(book, (threshold, alert_id, user_id, 0.0)))
+
+    def remove(self, alert_id: int, ticker: str) -> None:
+        rule = self._rules.get(ticker, {}).pop(alert_id, None)
+        if rule is None: return
+        if not self._rules[ticker]: del self._rules[ticker]
+        key = (ticker, rule[1])
+        book = self._book(key)
+        keep = book[1] != alert_id
+        self._books[key] = tuple(column[keep] for column in book)
+        if not len(self._books[key][0]): del self._books[key]
+
+    def tickers(self) -> list:
+        return list(self._rules)
+
+    def evaluate(self, ticker: str, price: float, change_pct: float, now: float = None) -> list:
+        """Returns (user_id, alert_id, kind, threshold) for every rule the quote triggers, and starts their cooldown."""
+        now = time.time() if now is None else now
+        self.evaluations += 1
+        hits = []
+        for kind, value in (('above', price), ('below', price), ('move', abs(change_pct))):
+            book = self._book((ticker, kind))
+            if book is None: continue
+            thresholds, alert_ids, user_ids, next_eligible = book
+            if kind == 'below': # threshold >= price
+                start, stop = int(np.searchsorted(thresholds, value, side='left')), len(thresholds)
+            else: # threshold <= value
+                start, stop = 0, int(np.searchsorted(thresholds, value, side='right'))
+            if start >= stop: continue
+            idx = np.flatnonzero(next_eligible[start:stop] <= now) + start
+            if not len(idx): continue
+            next_eligible[idx] = now + self.cooldown
+            hits.extend(zip(user_ids[idx].tolist(), alert_ids[idx].tolist(), [kind] * len(idx), thresholds[idx].tolist()))
+        self.triggered += len(hits)
+        return hits
+
+    def on_quote(self, ticker: str, info: dict) -> None:
+        price = info.get('regularMarketPrice')
+        if price is None or ticker not in self._rules: return
+        hits = self.evaluate(ticker, price, (info.get('regularMarketChangePercent') or 0) * 100)
+        if hits and self.on_trigger is not None:
+            self.on_trigger(ticker, info, hits)
+
+    def stats(self) -> dict:
+        return {"rules": sum(len(r) for r in self._rules.values()), "tickers": len(self._rules), "evaluations": self.evaluations, "triggered": self.triggered}
+
+alert_book = AlertBook(cooldown=ALERT_COOLDOWN)
+quote_cache.listeners.append(alert_book.on_quote)
+
+async def alert_symbols() -> list:
+    return alert_book.tickers()
+
+quote_refresher.sources.append(alert_symbols)
+
+def load_alerts() -> None:
+    alert_book.load(database.run_sync("SELECT alert_id, user_id, ticker_symbol, kind, threshold, last_triggered FROM alerts"))
+    logging.info(f"Loaded {alert_book.stats()['rules']} price alerts.")
+
+def format_alert_message(ticker: str, info: dict, rules: list) -> str:
+    currency_code = info.get('currency', ''); display_symbol = CURRENCY_SYMBOLS.get(currency_code, currency_code)
+    change_pct = (info.get('regularMarketChangePercent') or 0) * 100
+    lines = [f"🔔 **Price Alert: {ticker}**\n", f"Now at {display_symbol}{info['regularMarketPrice']:,.2f} ({change_pct:+.2f}%)"]
+    for kind, threshold in sorted(rules):
+        if kind == 'move': lines.append(f"• Moved more than {threshold:g}% today")
+        else: lines.append(f"• Crossed {kind} {display_symbol}{threshold:,.2f}")
+    return "\n".join(lines)
+
+def dispatch_alerts(application: Application, ticker: str, info: dict, hits: list) -> None:
+    application.create_task(deliver_alerts(ticker, info, hits))
+
+async def deliver_alerts(ticker: str, info: dict, hits: list) -> None:
+    """Queues one message per user, however many of their rules fired on this tick.
+
+    Rules are first claimed in `alerts` by stamping last_triggered, and only those outside their
+    cooldown there are sent, so another instance (or this one before a restart) that already
+    fired a rule keeps it quiet. Rules deleted in the meantime are skipped as well.
+    """
+    now = time.time()
+    rows = await db_execute("UPDATE alerts SET last_triggered = ? WHERE alert_id IN (SELECT value FROM json_each(?)) "
+                            "AND (last_triggered IS NULL OR last_triggered <= ?) RETURNING alert_id",
+                            (now, json.dumps([hit[1] for hit in hits]), now - alert_book.cooldown))
+    claimed = {row[0] for row in rows}
+    by_user = {}
+    for user_id, alert_id, kind, threshold in hits:
+        if alert_id in claimed: by_user.setdefault(user_id, []).append((kind, threshold))
+    messages = [(user_id, format_alert_message(ticker, info, rules)) for user_id, rules in by_user.items()]
+    if messages: await delivery_queue.enqueue_many(messages, parse_mode='Markdown')
+
+# --- Price History ---
+def last_completed_session(ticker_symbol: str) -> np.datetime64:
+    """Date of the latest daily bar that can no longer change (weekends skipped, holidays not modelled)."""
+    market = market_for(ticker_symbol)
+    if market not in MARKET_SESSIONS:
+        return np.datetime64(datetime.now(ZoneInfo("UTC")).date() - timedelta(days=1), 'D')
+    tz, _, closes = MARKET_SESSIONS[market]
+    now = datetime.now(tz)
+    day = now.date() if now.weekday() < 5 and now.time() >= closes else now.date() - timedelta(days=1)
+    while day.weekday() >= 5: day -= timedelta(days=1)
+    return np.datetime64(day, 'D')
+
+class HistoryStore:
+    """Daily OHLCV bars on disk: one memory-mapped .npy file of history_dtype() records per symbol.
+
+    Syncs are incremental. Only sessions after the last stored bar are downloaded, and each
+    symbol is checked upstream at most once per completed session, so repeat reads are served
+    straight from the mapped file. Files are rewritten atomically when new bars arrive.
+    """
+
+    def __init__(self, directory: str, years: float, max_open: int):
+        self.directory = directory
+        self.years = years
+        self.max_open = max_open
+        self._open = OrderedDict() # symbol -> memory-mapped bars
+        self._synced = {} # symbol -> last completed session already synced
+        self._locks = weakref.WeakValueDictionary()
+        self.syncs = self.bars_fetched = 0
+
+    def _path(self, symbol: str) -> str:
+        return os.path.join(self.directory, re.sub(r'[^A-Za-z0-9.^=-]', '_', symbol) + ".npy")
+
+    def load(self, symbol: str) -> np.ndarray:
+        """Returns the stored bars without syncing (an empty array if there are none)."""
+        bars = self._open.get(symbol)
+        if bars is None:
+            try:
+                bars = np.load(self._path(symbol), mmap_mode='r')
+            except FileNotFoundError:
+                return np.empty(0, dtype=history_dtype())
+            self._open[symbol] = bars
+            while len(self._open) > self.max_open:
+                self._open.popitem(last=False)
+        self._open.move_to_end(symbol)
+        return bars
+
+    def _save(self, symbol: str, bars: np.ndarray) -> np.ndarray:
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(symbol)
+        with open(path + ".tmp", 'wb') as f:
+            np.save(f, bars)
+        os.replace(path + ".tmp", path)
+        return np.load(path, mmap_mode='r')
+
+    async def bars(self, symbol: str) -> np.ndarray:
+        """Returns all stored bars for symbol, first downloading any completed sessions that are missing."""
+        target = last_completed_session(symbol)
+        if self._synced.get(symbol) == target: return self.load(symbol)
+        lock = self._locks.get(symbol)
+        if lock is None:
+            lock = self._locks[symbol] = asyncio.Lock()
+        async with lock:
+            bars = self.load(symbol)
+            if self._synced.get(symbol) == target: return bars
+            last = bars['date'][-1] if len(bars) else target - np.timedelta64(round(self.years * 365.25), 'D')
+            if last < target:
+                try:
+                    fresh = await fetch_history(symbol, last + 1, target + 1)
+                except Exception as e:
+                    if not len(bars): raise
+                    logging.warning(f"History sync for {symbol} failed, serving stored bars: {e}")
+                    return bars
+                fresh = fresh[(fresh['date'] > last) & (fresh['date'] <= target)]
+                if len(fresh):
+                    bars = await asyncio.to_thread(self._save, symbol, np.concatenate([bars, fresh]))
+                    self._open[symbol] = bars
+                    self.bars_fetched += len(fresh)
+                self.syncs += 1
+            self._synced[symbol] = target
+            return bars
+
+    def stats(self) -> dict:
+        return {"open": len(self._open), "syncs": self.syncs, "bars_fetched": self.bars_fetched}
+
+history_store = HistoryStore(HISTORY_DIR, HISTORY_YEARS, HISTORY_MAX_OPEN)
+HISTORY_PERIODS = {'1mo': 21, '3mo': 63, '6mo': 126, 'ytd': None, '1y': 252, '2y': 504, '5y': 1260, 'max': None} # Sessions per period
+
+def history_stats(bars: np.ndarray, period: str) -> dict:
+    """Return, volatility, drawdown, moving averages and 52-week range over the stored bars."""
+    if period == 'ytd':
+        sessions = int(np.count_nonzero(bars['date'] >= bars['date'][-1].astype('datetime64[Y]')))
+    else:
+        sessions = HISTORY_PERIODS[period] or len(bars)
+    closes = np.asarray(bars['close'])
+    window = closes[-(sessions + 1):] # One extra bar so returns span `sessions` sessions
+    log_returns = np.diff(np.log(window))
+    year = bars[-252:]
+    return {
+        'start': bars['date'][-len(window)], 'end': bars['date'][-1], 'sessions': len(window) - 1, 'last': closes[-1],
+        'return': window[-1] / window[0] - 1,
+        'volatility': log_returns.std(ddof=1) * np.sqrt(252) if len(log_returns) > 1 else 0.0,
+        'max_drawdown': (window / np.maximum.accumulate(window) - 1).min(),
+        'high_52w': year['high'].max(), 'low_52w': year['low'].min(),
+        'sma': {n: closes[-n:].mean() for n in (20, 50, 200) if len(closes) >= n},
+    }
+
+async def get_history_message(ticker_symbol: str, period: str) -> str:
+    try:
+        bars = await history_store.bars(ticker_symbol)
+    except UpstreamUnavailable as e:
+        return f"Yahoo Finance is busy right now. Please try again in about {max(5, e.retry_in):.0f} seconds."
+    except Exception as e:
+        logging.error(f"Error loading history for {ticker_symbol}: {e}")
+        return "Sorry, an error occurred while fetching the price history."
+    if len(bars) < 2: return f"No price history found for `{ticker_symbol}`."
+    stats = history_stats(bars, period)
+    symbol = CURRENCY_SYMBOLS.get(guess_currency(ticker_symbol), '')
+    sma = " / ".join(f"{symbol}{value:,.2f}" for value in stats['sma'].values())
+    return (f"🕰️ **{ticker_symbol} · {period.upper()} History**\n_{stats['start']} → {stats['end']}, {stats['sessions']} sessions_\n\n"
+            f"**Last Close:** {symbol}{stats['last']:,.2f}\n"
+            f"**Return:** {stats['return']:+.2%}\n"
+            f"**Volatility (ann.):** {stats['volatility']:.1%}\n"
+            f"**Max Drawdown:** {stats['max_drawdown']:.1%}\n"
+            f"**52-Week Range:** {symbol}{stats['low_52w']:,.2f} – {symbol}{stats['high_52w']:,.2f}\n"
+            + (f"**SMA {'/'.join(map(str, stats['sma']))}:** {sma}" if sma else ""))
+
+# --- Portfolio ---
+MINOR_CURRENCY_UNITS = {'GBp': ('GBP', 100.0), 'GBX': ('GBP', 100.0), 'ZAc': ('ZAR', 100.0), 'ILA': ('ILS', 100.0)} # Quoted in pence, cents, agorot
+
+def fx_symbol(currency: str) -> str:
+    return f"{currency}{PORTFOLIO_BASE_CURRENCY}=X"
+
+def quote_currency(info) -> tuple:
+    """(currency, divisor) for a quote: minor units such as GBp map to their major currency; '' if unknown."""
+    code = info.get('currency') if isinstance(info, dict) else None
+    return MINOR_CURRENCY_UNITS.get(code, (code or '', 1.0))
+
+def value_portfolio(tickers: list, quantity: np.ndarray, avg_cost: np.ndarray, quotes: dict) -> dict:
+    """Values all positions at once in PORTFOLIO_BASE_CURRENCY.
+
+    `quotes` maps every ticker and the FX pair of every foreign currency to a quote dict
+    (or an Exception). Average costs are in the ticker's quoted unit (e.g. pence for GBp).
+    Positions without a price, a known currency or an FX rate are NaN and left out of the
+    totals; positions without an average cost are left out of the overall P&L.
+    """
+    def field(name: str, symbols: list) -> np.ndarray:
+        return np.array([q.get(name, np.nan) if isinstance(q := quotes.get(s), dict) else np.nan for s in symbols], dtype='f8')
+    currencies, divisor = zip(*(quote_currency(quotes.get(t)) for t in tickers))
+    currencies, divisor = np.array(currencies), np.array(divisor, dtype='f8')
+    unique, inverse = np.unique(currencies, return_inverse=True)
+    rates = np.where(unique == '', np.nan, field('regularMarketPrice', [fx_symbol(c) for c in unique]))
+    fx = np.where(unique == PORTFOLIO_BASE_CURRENCY, 1.0, rates)[inverse]
+    price = field('regularMarketPrice', tickers) / divisor
+    value = quantity * price * fx
+    day_pnl = quantity * np.nan_to_num(field('regularMarketChange', tickers)) / divisor * fx
+    cost = quantity * avg_cost / divisor * fx
+    pnl = value - cost
+    total = np.nansum(value)
+    return {
+        'currencies': currencies, 'price': price, 'value': value, 'day_pnl': day_pnl, 'cost': cost, 'pnl': pnl,
+        'weights': np.nan_to_num(value / total) if total else np.zeros(len(tickers)),
+        'total': total, 'total_day_pnl': np.nansum(day_pnl), 'total_cost': np.nansum(cost[np.isfinite(pnl)]), 'total_pnl': np.nansum(pnl),
+    }
+
+def portfolio_risk(histories: list, weights: np.ndarray, sessions: int = 252) -> dict:
+    """Annualised volatilities, correlation matrix and portfolio volatility from aligned daily log returns."""
+    recent = [bars[-(sessions + 1):] for bars in histories]
+    dates = np.unique(np.concatenate([bars['date'] for bars in recent]))
+    closes = np.full((len(dates), len(recent)), np.nan)
+    for column, bars in enumerate(recent):
+        closes[np.searchsorted(dates, bars['date']), column] = bars['close']
+    # Forward-fill across other markets' sessions and holidays, then keep days where every position trades
+    filled = np.where(np.isnan(closes), 0, np.arange(len(dates))[:, None])
+    closes = closes[np.maximum.accumulate(filled, axis=0), np.arange(len(recent))]
+    returns = np.diff(np.log(closes), axis=0)
+    returns = returns[np.isfinite(returns).all(axis=1)]
+    if len(returns) < 2: return None
+    covariance = np.atleast_2d(np.cov(returns, rowvar=False)) * 252
+    volatility = np.sqrt(np.diag(covariance))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        correlation = np.nan_to_num(covariance / np.outer(volatility, volatility))
+    w = weights / weights.sum() if weights.sum() else weights
+    return {'volatility': volatility, 'correlation': correlation, 'portfolio_volatility': float(np.sqrt(w @ covariance @ w)), 'sessions': len(returns)}
+
+async def get_portfolio_message(user_id: int) -> str:
+    rows = await db_query("SELECT ticker_symbol, quantity, avg_cost FROM watchlist WHERE user_id = ? AND quantity IS NOT NULL ORDER BY watchlist_id", (user_id,))
+    if not rows:
+        return "Your portfolio is empty. Record a holding with `/hold <TICKER> <quantity> [average cost]`."
+    tickers = [row[0] for row in rows]
+    quantity = np.array([row[1] for row in rows], dtype='f8')
+    avg_cost = np.array([np.nan if row[2] is None else row[2] for row in rows], dtype='f8')
+    # History syncs run alongside the quote fetch; the risk section uses whatever is ready in time
+    history_tasks = [asyncio.ensure_future(history_store.bars(t)) for t in tickers]
+    for task in history_tasks: task.add_done_callback(lambda t: t.cancelled() or t.exception())
+    quotes = await quote_cache.get_many(tickers)
+    # Bulk downloads only know the currency of US and Indian listings; the full quote has it for the rest
+    unknown = [t for t in tickers if isinstance(quotes.get(t), dict) and not quotes[t].get('currency')]
+    if unknown:
+        full = await asyncio.gather(*(quote_cache.get(t, full=True) for t in unknown), return_exceptions=True)
+        quotes.update((t, info) for t, info in zip(unknown, full) if isinstance(info, dict))
+    foreign = {c for t in tickers if (c := quote_currency(quotes.get(t))[0]) and c != PORTFOLIO_BASE_CURRENCY}
+    if foreign: quotes.update(await quote_cache.get_many([fx_symbol(c) for c in foreign]))
+    book = value_portfolio(tickers, quantity, avg_cost, quotes)
+    await asyncio.wait(history_tasks, timeout=PORTFOLIO_RISK_WAIT)
+
+    base = CURRENCY_SYMBOLS.get(PORTFOLIO_BASE_CURRENCY, PORTFOLIO_BASE_CURRENCY)
+    total, day_pnl, total_pnl, total_cost = book['total'], book['total_day_pnl'], book['total_pnl'], book['total_cost']
+    lines = [f"💼 **Your Portfolio** (in {PORTFOLIO_BASE_CURRENCY})\n",
+             f"**Total Value:** {base}{total:,.2f}",
+             f"**Day P&L:** {day_pnl:+,.2f} ({day_pnl / (total - day_pnl) if total != day_pnl else 0:+.2%})"]
+    if total_cost: lines.append(f"**Overall P&L:** {total_pnl:+,.2f} ({total_pnl / total_cost:+.2%}) on cost {base}{total_cost:,.2f}")
+    lines.append("\n**Positions** (weight · value · P&L)")
+    order = np.argsort(-np.nan_to_num(book['value'], nan=-1))
+    for i in order[:20]:
+        if not np.isfinite(book['value'][i]):
+            currency = book['currencies'][i]
+            reason = "price unavailable" if not np.isfinite(book['price'][i]) else f"no {currency} exchange rate" if currency else "currency unknown"
+            lines.append(f"• `{tickers[i]}`: {reason}")
+            continue
+        pnl = f" · {book['pnl'][i] / book['cost'][i]:+.1%}" if np.isfinite(book['pnl'][i]) and book['cost'][i] else ""
+        lines.append(f"• `{tickers[i]}` {quantity[i]:g} × {CURRENCY_SYMBOLS.get(book['currencies'][i], book['currencies'][i])}{book['price'][i]:,.2f}"
+                     f" · {book['weights'][i]:.1%} · {base}{book['value'][i]:,.0f}{pnl}")
+    if len(order) > 20: lines.append(f"…and {len(order) - 20} more")
+
+    ready = [i for i, task in enumerate(history_tasks) if task.done() and not task.cancelled() and task.exception() is None and len(task.result()) > 2]
+    risk = portfolio_risk([history_tasks[i].result() for i in ready], book['weights'][ready]) if ready else None
+    if risk is None:
+        lines.append("\n_Risk summary will be available once price history has synced._")
+        return "\n".join(lines)
+    held = [tickers[i] for i in ready]
+    lines.append(f"\n**Risk** ({risk['sessions']} sessions of daily returns)")
+    lines.append(f"Portfolio volatility (ann.): {risk['portfolio_volatility']:.1%}")
+    lines.append("Most volatile: " + ", ".join(f"`{held[i]}` {risk['volatility'][i]:.0%}" for i in np.argsort(-risk['volatility'])[:3]))
+    if len(held) > 1:
+        upper = np.triu_indices(len(held), 1)
+        pair_corr = risk['correlation'][upper]
+        lines.append(f"Average correlation: {pair_corr.mean():.2f}")
+        if len(held) <= 5: # Small enough to show the whole matrix
+            header = "       " + " ".join(f"{t[:6]:>6}" for t in held)
+            rows_text = [f"{t[:6]:<6} " + " ".join(f"{c:6.2f}" for c in row) for t, row in zip(held, risk['correlation'])]
+            lines.append("```\n" + "\n".join([header] + rows_text) + "\n```")
+        else:
+            top = np.argsort(-pair_corr)[:3]
+            lines.append("Most correlated: " + ", ".join(f"`{held[upper[0][k]]}`/`{held[upper[1][k]]}` {pair_corr[k]:.2f}" for k in top))
+    if len(ready) < len(tickers): lines.append(f"_{len(tickers) - len(ready)} positions without synced history are not included._")
+    return "\n".join(lines)
+
+# --- Quiz Engine ---
+QUIZ_UPSERT = ("INSERT INTO quiz_questions (question_id, category, difficulty, question, options, correct, explanation) VALUES (?, ?, ?, ?, ?, ?, ?) "
+               "ON CONFLICT(question_id) DO UPDATE SET category = excluded.category, difficulty = excluded.difficulty, question = excluded.question, "
+               "options = excluded.options, correct = excluded.correct, explanation = excluded.explanation")
+
+def load_quiz_bank() -> None:
+    """Upserts the built-in questions, then QUIZ_FILE (question_id,category,difficulty,question,options,correct,explanation; options '|'-separated)."""
+    rows = [(i + 1, q['category'], q['difficulty'], q['question'], json.dumps(q['options']), q['correct'], q['explanation']) for i, q in enumerate(QUIZ_QUESTIONS)]
+    try:
+        with open(QUIZ_FILE, newline='', encoding='utf-8') as f:
+            rows += [(int(r['question_id']), r['category'], int(r['difficulty']), r['question'], json.dumps(r['options'].split('|')), int(r['correct']), r['explanation'])
+                     for r in csv.DictReader(f)]
+    except FileNotFoundError:
+        pass
+    database.run_sync(QUIZ_UPSERT, rows)
+    quiz_bank.refresh()
+    logging.info(f"Quiz bank loaded with {quiz_bank.size} questions in {len(quiz_bank.categories)} categories.")
+
+class QuizBank:
+    """Question selection and spaced-repetition scheduling over the quiz tables.
+
+    The next question is the user's most overdue review, else an unanswered question found from a
+    random starting id by an indexed anti-join, so neither memory nor work grows with the bank.
+    """
+
+    def __init__(self, intervals: tuple):
+        self.intervals = intervals
+        self.size = self.max_id = 0
+        self.categories = []
+
+    def refresh(self) -> None:
+        self.size, self.max_id = database.run_sync("SELECT COUNT(*), COALESCE(MAX(question_id), 0) FROM quiz_questions")[0]
+        self.categories = [row[0] for row in database.run_sync("SELECT DISTINCT category FROM quiz_questions ORDER BY category")]
+
+    async def question(self, question_id: int):
+        rows = await db_query("SELECT question_id, category, difficulty, question, options, correct, explanation FROM quiz_questions WHERE question_id = ?", (question_id,))
+        if not rows: return None
+        question_id, category, difficulty, text, options, correct, explanation = rows[0]
+        return {'id': question_id, 'category': category, 'difficulty': difficulty, 'question': text, 'options': json.loads(options), 'correct': correct, 'explanation': explanation}
+
+    async def next_question_id(self, user_id: int, category: str = None):
+        """Returns (question_id, is_review), or (None, seconds until the next review) when nothing is due."""
+        now = time.time()
+        due = await db_query("SELECT p.question_id FROM quiz_progress p JOIN quiz_questions q ON q.question_id = p.question_id "
+                             "WHERE p.user_id = ? AND p.due <= ? AND (? IS NULL OR q.category = ?) ORDER BY p.due LIMIT 1", (user_id, now, category, category))
+        if due: return due[0][0], True
+        unseen = ("SELECT question_id FROM quiz_questions q WHERE question_id >= ? AND (? IS NULL OR category = ?) "
+                  "AND NOT EXISTS (SELECT 1 FROM quiz_progress p WHERE p.user_id = ? AND p.question_id = q.question_id) ORDER BY question_id LIMIT 1")
+        for start in (random.randint(1, max(1, self.max_id)), 0): # Random start for variety, then wrap around
+            rows = await db_query(unseen, (start, category, category, user_id))
+            if rows: return rows[0][0], False
+        upcoming = await db_query("SELECT MIN(p.due) FROM quiz_progress p JOIN quiz_questions q ON q.question_id = p.question_id "
+                                  "WHERE p.user_id = ? AND (? IS NULL OR q.category = ?)", (user_id, category, category))
+        return None, (upcoming[0][0] - now) if upcoming and upcoming[0][0] else None
+
+    async def record_answer(self, user_id: int, question_id: int, correct: bool) -> float:
+        """Moves the question up a box (or back to the first) and returns the delay until its next review."""
+        rows = await db_query("SELECT box FROM quiz_progress WHERE user_id = ? AND question_id = ?", (user_id, question_id))
+        box = min(rows[0][0] + 1, len(self.intervals) - 1) if rows and correct else (1 if correct else 0)
+        await db_execute("INSERT OR REPLACE INTO quiz_progress (user_id, question_id, box, due) VALUES (?, ?, ?, ?)",
+                         (user_id, question_id, box, time.time() + self.intervals[box]))
+        return self.intervals[box]
+
+    async def answered(self, user_id: int) -> int:
+        return (await db_query("SELECT COUNT(*) FROM quiz_progress WHERE user_id = ?", (user_id,)))[0][0]
+
+quiz_bank = QuizBank(QUIZ_INTERVALS)
+
+# --- Symbol Search Index ---
+class SymbolIndex:
+    """In-memory index of ticker symbols and company names for /search.
+
+    Every token of every symbol and name sits in one sorted list, so a prefix lookup is a
+    bisect plus a short scan. Typo-tolerant lookups match query tokens against the token
+    vocabulary with difflib. Results use the same dict shape as Yahoo's search quotes.
+    """
+
+    def __init__(self):
+        self._records = {} # symbol -> {'symbol', 'longname', 'exchange', 'rank'}
+        self._tokens = [] # sorted (token, symbol)
+        self._vocabulary = {} # token -> number of symbols using it
+
+    @staticmethod
+    def _tokenize(text: str) -> list:
+        return re.findall(r"[a-z0-9&]+", text.lower())
+
+    def _index_record(self, symbol: str, name: str, exchange: str) -> list:
+        self._records[symbol] = {'symbol': symbol, 'longname': name, 'exchange': exchange, 'rank': len(self._records)}
+        tokens = set(self._tokenize(symbol)) | set(self._tokenize(name))
+        for token in tokens:
+            self._vocabulary[token] = self._vocabulary.get(token, 0) + 1
+        return [(token, symbol) for token in tokens]
+
+    def load(self, rows) -> None:
+        """Bulk-loads (symbol, name, exchange) rows, keeping the first occurrence of each symbol."""
+        for symbol, name, exchange in rows:
+            if symbol and symbol not in self._records:
+                self._tokens.extend(self._index_record(symbol, name or symbol, exchange or ''))
+        self._tokens.sort()
+
+    def add(self, symbol: str, name: str, exchange: str = '') -> bool:
+        if not symbol or symbol in self._records: return False
+        for entry in self._index_record(symbol, name or symbol, exchange or ''):
+            bisect.insort(self._tokens, entry)
+        return True
+
+    def _prefix_symbols(self, prefix: str) -> set:
+        symbols = set()
+        i = bisect.bisect_left(self._tokens, (prefix,))
+        while i < len(self._tokens) and self._tokens[i][0].startswith(prefix):
+            symbols.add(self._tokens[i][1])
+            i += 1
+        return symbols
+
+    def _fuzzy_symbols(self, token: str) -> set:
+        symbols = set()
+        for match in difflib.get_close_matches(token, list(self._vocabulary), n=3, cutoff=0.75):
+            symbols |= self._prefix_symbols(match)
+        return symbols
+
+    def search(self, search_term: str, limit: int = 5, fuzzy: bool = False) -> list:
+        """Returns up to `limit` matches: exact symbols first, then name-phrase prefixes, then token prefixes."""
+        query_tokens = self._tokenize(search_term)
+        if not query_tokens: return []
+        candidates = set.intersection(*(self._prefix_symbols(token) for token in query_tokens))
+        if not candidates and fuzzy:
+            candidates = set.intersection(*(self._fuzzy_symbols(token) for token in query_tokens))
+        compact, phrase = "".join(query_tokens), " ".join(query_tokens)
+
+        def score(symbol: str) -> tuple:
+            record = self._records[symbol]
+            if symbol.lower().split('.')[0].lstrip('^') == compact: tier = 0
+            elif " ".join(self._tokenize(record['longname'])).startswith(phrase): tier = 1
+            else: tier = 2
+            return (tier, record['rank'])
+
+        return [self._records[symbol] for symbol in sorted(candidates, key=score)[:limit]]
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+symbol_index = SymbolIndex()
+
+def load_symbol_index() -> None:
+    """Loads the bundled listings file, then symbols learned from earlier remote searches."""
+    try:
+        with open(SYMBOLS_FILE, newline='', encoding='utf-8') as f:
+            symbol_index.load((row['symbol'], row['name'], row['exchange']) for row in csv.DictReader(f))
+    except FileNotFoundError:
+        logging.warning(f"Symbols file {SYMBOLS_FILE} not found; /search will rely on Yahoo.")
+    symbol_index.load(database.run_sync("SELECT symbol, name, exchange FROM symbols ORDER BY rowid"))
+    logging.info(f"Symbol index loaded with {len(symbol_index)} symbols.")
+
+async def search_symbols_remote(search_term: str) -> list:
+    """Yahoo search fallback; new symbols are merged into the local index and persisted."""
+    quotes = [q for q in await yahoo_search(search_term) if q.get('symbol')]
+    learned = []
+    for q in quotes:
+        name = q.get('longname') or q.get('shortname') or q['symbol']
+        if symbol_index.add(q['symbol'], name, q.get('exchange', '')):
+            learned.append((q['symbol'], name, q.get('exchange', '')))
+    if learned:
+        await db_execute("INSERT OR IGNORE INTO symbols (symbol, name, exchange) VALUES (?, ?, ?)", learned)
+    return quotes
+
+# Remote results per normalised search term; reuses the quote cache's TTL, LRU and coalescing
+search_cache = QuoteCache(search_symbols_remote, None, ttl=SEARCH_CACHE_TTL, max_entries=SEARCH_CACHE_MAX_ENTRIES)
+
+def build_search_keyboard(quotes: list) -> InlineKeyboardMarkup:
+    keyboard = []
+    for q in quotes[:5]:
+        symbol = q.get('symbol'); name = q.get('longname') or 'N/A'
+        if not symbol: continue
+        keyboard.append([
+            InlineKeyboardButton(f"{symbol} ({name[:25]})", callback_data=f"price_{symbol}"),
+            InlineKeyboardButton("➕", callback_data=f"add_from_search_{symbol}")
+        ])
+    return InlineKeyboardMarkup(keyboard)
+
 # --- UI & Formatting Helper Functions ---
+# Static menus are rendered once at import; telegram objects are immutable, so every tap can reuse them
+WELCOME_TEXT = "Welcome to **Zenith Finance**! 🧭\n\nYour trusted guide to the financial world. Please select an option to begin:"
+MAIN_MENU_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📚 Financial Resources", callback_data="show_resources_menu")],
+    [InlineKeyboardButton("📈 Live Market Data", callback_data="show_market_menu")],
+    [InlineKeyboardButton("👀 My Watchlist", callback_data="show_watchlist")],
+    [InlineKeyboardButton("🛠️ More Tools", callback_data="show_more_tools")]
+])
+BACK_TO_MAIN_BUTTON = InlineKeyboardButton("⬅️ Back to Main Menu", callback_data="main_menu")
+MORE_TOOLS_TEXT = "🛠️ **More Tools**\n\nSelect a tool to use:"
+MORE_TOOLS_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🚀 Market Movers (Moneycontrol)", url="https://www.moneycontrol.com/stocks/marketstats/nsegainer/index.php")],
+    [InlineKeyboardButton("🧠 Financial Quiz", callback_data="start_quiz")],
+    [BACK_TO_MAIN_BUTTON]
+])
+MARKET_MENU_TEXT = (
+    "📈 **Live Market Data**\n\n"
+    "Use `/search <company name>` to find a stock symbol.\n"
+    "**Example:** `/search Apple`\n\n"
+    "If you already know the symbol, use `/price <symbol>`.\n"
+    "**Example:** `/price AAPL`"
+)
+MARKET_MENU_KEYBOARD = InlineKeyboardMarkup([[BACK_TO_MAIN_BUTTON]])
+RESOURCES_MENU_TEXT = "📚 **Financial Resources**\n\nSelect a category to explore:"
+RESOURCES_MENU_KEYBOARD = InlineKeyboardMarkup(
+    [[InlineKeyboardButton(FINANCIAL_LINKS[k]["title"], callback_data=k)] for k in sorted(FINANCIAL_LINKS)] + [[BACK_TO_MAIN_BUTTON]])
+BACK_TO_RESOURCES_KEYBOARD = InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Back to Resources", callback_data="show_resources_menu")]])
+RESOURCE_PAGES = { # category key -> rendered message text
+    key: f"**{category['title']}**\n_{category['description']}_\n\n" + "".join(f"🔗 [{link['name']}]({link['url']}) - {link['desc']}\n" for link in category["links"])
+    for key, category in FINANCIAL_LINKS.items()
+}
+
 def get_main_menu_keyboard() -> InlineKeyboardMarkup:
-    # <<< UPDATED: Helper function for reusability >>>
-    keyboard = [
-        [InlineKeyboardButton("📚 Financial Resources", callback_data="show_resources_menu")],
-        [InlineKeyboardButton("📈 Live Market Data", callback_data="show_market_menu")],
-        [InlineKeyboardButton("👀 My Watchlist", callback_data="show_watchlist")],
-        [InlineKeyboardButton("🛠️ More Tools", callback_data="show_more_tools")]
-    ]
-    return InlineKeyboardMarkup(keyboard)
+    return MAIN_MENU_KEYBOARD
+
+def format_age(seconds: float) -> str:
+    if seconds < 120: return f"{seconds:.0f}s"
+    if seconds < 7200: return f"{seconds / 60:.0f}m"
+    if seconds < 172800: return f"{seconds / 3600:.0f}h"
+    return f"{seconds / 86400:.0f}d"
+
+def staleness_note(ticker_symbol: str) -> str:
+    """'' for fresh quotes, else how old the served quote is."""
+    age = quote_cache.age(ticker_symbol)
+    if age is None or age <= quote_cache.ttl_for(ticker_symbol): return ""
+    return f"⏳ updated {format_age(age)} ago"
 
-def is_in_watchlist(user_id: int, ticker_symbol: str) -> bool:
-    res = db_query("SELECT 1 FROM watchlist WHERE user_id = ? AND ticker_symbol = ?", (user_id, ticker_symbol))
-    return bool(res)
+async def is_in_watchlist(user_id: int, ticker_symbol: str) -> bool:
+    return await watchlist_index.contains(user_id, ticker_symbol)
 
-def create_stock_details_keyboard(ticker_symbol: str, user_id: int) -> InlineKeyboardMarkup:
+async def create_stock_details_keyboard(ticker_symbol: str, user_id: int) -> InlineKeyboardMarkup:
     summary_url = f"https://finance.yahoo.com/quote/{ticker_symbol}"
-    if is_in_watchlist(user_id, ticker_symbol):
+    if await is_in_watchlist(user_id, ticker_symbol):
         watchlist_button = InlineKeyboardButton("➖ Remove from Watchlist", callback_data=f"remove_from_details_{ticker_symbol}")
     else:
         watchlist_button = InlineKeyboardButton("➕ Add to Watchlist", callback_data=f"add_from_details_{ticker_symbol}")
-    keyboard = [[InlineKeyboardButton("📊 Full Report (Yahoo Finance)", url=summary_url)], [watchlist_button], [InlineKeyboardButton("⬅️ Back to Main Menu", callback_data="main_menu")]]
+    keyboard = [[InlineKeyboardButton("📊 Full Report (Yahoo Finance)", url=summary_url)], [InlineKeyboardButton("🕰️ 1Y History", callback_data=f"history_{ticker_symbol}")],
+                [watchlist_button], [InlineKeyboardButton("⬅️ Back to Main Menu", callback_data="main_menu")]]
     return InlineKeyboardMarkup(keyboard)
 
+def format_quote_message(ticker_symbol: str, info: dict, company_name: str = None, footer: str = "Click buttons below for a full report or to manage your watchlist.") -> str:
+    current_price = info['regularMarketPrice']
+    currency_code = info.get('currency', ''); display_symbol = CURRENCY_SYMBOLS.get(currency_code, currency_code)
+    company_name = info.get('longName') or company_name or 'N/A'; change = info.get('regularMarketChange') or 0; percent_change = (info.get('regularMarketChangePercent') or 0) * 100
+    emoji = "📈" if change >= 0 else "📉"
+    stale = staleness_note(ticker_symbol)
+    price_label = f"**Last Price** ({stale}):" if stale else "**Live Price:**"
+    return (f"**{company_name} ({ticker_symbol})** {emoji}\n\n"
+            f"{price_label} {display_symbol}{current_price:,.2f}\n"
+            f"**Change:** {change:+.2f} ({percent_change:+.2f}%)" + (f"\n\n{footer}" if footer else ""))
+
 async def get_stock_price_message(ticker_symbol: str) -> str:
     try:
-        info = yf.Ticker(ticker_symbol).info
-        current_price = info.get('regularMarketPrice')
-        if current_price is None: return f"Could not find data for `'{ticker_symbol}'`."
-        currency_code = info.get('currency', ''); display_symbol = {'INR': '₹', 'USD': '$'}.get(currency_code, currency_code)
-        company_name = info.get('longName', 'N/A'); change = info.get('regularMarketChange', 0); percent_change = info.get('regularMarketChangePercent', 0) * 100
-        emoji = "📈" if change >= 0 else "📉"
-        return (f"**{company_name} ({ticker_symbol})** {emoji}\n\n"
-                f"**Live Price:** {display_symbol}{current_price:,.2f}\n"
-                f"**Change:** {change:+.2f} ({percent_change:+.2f}%)\n\n"
-                f"Click buttons below for a full report or to manage your watchlist.")
+        info = await quote_cache.get(ticker_symbol, full=True)
+        if info.get('regularMarketPrice') is None: return f"Could not find data for `'{ticker_symbol}'`."
+        return format_quote_message(ticker_symbol, info)
+    except UpstreamUnavailable as e:
+        return f"Yahoo Finance is busy right now. Please try again in about {max(5, e.retry_in):.0f} seconds."
     except Exception as e:
         logging.error(f"Error in get_stock_price_message: {e}")
         return "Sorry, an error occurred while fetching the price."
@@ -202,10 +2115,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
     await cleanup_previous_message(context, chat_id)
     
-    reply_markup = get_main_menu_keyboard() # <<< UPDATED: Use helper
-    welcome_text = "Welcome to **Zenith Finance**! 🧭\n\nYour trusted guide to the financial world. Please select an option to begin:"
-    
-    sent_message = await context.bot.send_message(chat_id=chat_id, text=welcome_text, reply_markup=reply_markup, parse_mode='Markdown')
+    sent_message = await context.bot.send_message(chat_id=chat_id, text=WELCOME_TEXT, reply_markup=MAIN_MENU_KEYBOARD, parse_mode='Markdown')
     context.user_data['last_message_id'] = sent_message.message_id
     
 async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -216,9 +2126,12 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         return
 
     try:
-        user_count_result = db_query("SELECT COUNT(*) FROM users;")
+        user_count_result = await db_query("SELECT COUNT(*) FROM users;")
         user_count = user_count_result[0][0] if user_count_result else 0
-        message = f"📊 **Bot Statistics**\n\nTotal Unique Users: `{user_count}`"
+        cache = quote_cache.stats()
+        message = (f"📊 **Bot Statistics**\n\nTotal Unique Users: `{user_count}`\n"
+                   f"Quote Cache: `{cache['size']}` symbols, `{cache['hits']}` hits, `{cache['misses']}` misses, `{cache['coalesced']}` coalesced\n"
+                   + format_stats_summary())
         await update.message.reply_text(message, parse_mode='Markdown')
     except Exception as e:
         logging.error(f"Error in stats_command: {e}")
@@ -234,26 +2147,26 @@ async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return
         
     search_term = " ".join(context.args)
+    quotes = symbol_index.search(search_term)
+    if quotes: # Answered from the local index, no network round-trip
+        sent_message = await update.message.reply_text(f"Top results for '{search_term}':", reply_markup=build_search_keyboard(quotes))
+        context.user_data['last_message_id'] = sent_message.message_id
+        return
+
     sent_message = await update.message.reply_text(f"Searching for '{search_term}'...")
     try:
-        response = requests.get(f"https://query1.finance.yahoo.com/v1/finance/search?q={search_term}", headers={'User-Agent': 'Mozilla/5.0'})
-        response.raise_for_status()
-        quotes = response.json().get('quotes', [])
-        if not quotes:
-            await sent_message.edit_text(f"No results found for '{search_term}'.")
-            return
-        
-        keyboard = []
-        for q in quotes[:5]:
-            symbol = q.get('symbol'); name = q.get('longname', 'N/A')
-            if not symbol: continue
-            keyboard.append([
-                InlineKeyboardButton(f"{symbol} ({name[:25]})", callback_data=f"price_{symbol}"),
-                InlineKeyboardButton("➕", callback_data=f"add_from_search_{symbol}")
-            ])
-        await sent_message.edit_text(f"Top results for '{search_term}':", reply_markup=InlineKeyboardMarkup(keyboard))
-    except Exception:
+        quotes = await search_cache.get(" ".join(search_term.lower().split()))
+    except Exception as e:
+        logging.warning(f"Remote search failed for '{search_term}': {e}")
+        quotes = None
+    if not quotes:
+        quotes = symbol_index.search(search_term, fuzzy=True) or quotes
+    if quotes:
+        await sent_message.edit_text(f"Top results for '{search_term}':", reply_markup=build_search_keyboard(quotes))
+    elif quotes is None:
         await sent_message.edit_text("Search service unavailable.")
+    else:
+        await sent_message.edit_text(f"No results found for '{search_term}'.")
     context.user_data['last_message_id'] = sent_message.message_id
 
 async def price_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -268,7 +2181,7 @@ async def price_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     ticker = " ".join(context.args).upper(); user_id = update.effective_user.id
     sent_message = await update.message.reply_text(f"Fetching data for `{ticker}`...", parse_mode='Markdown')
     message_text = await get_stock_price_message(ticker)
-    await sent_message.edit_text(message_text, parse_mode='Markdown', reply_markup=create_stock_details_keyboard(ticker, user_id))
+    await sent_message.edit_text(message_text, parse_mode='Markdown', reply_markup=await create_stock_details_keyboard(ticker, user_id))
     context.user_data['last_message_id'] = sent_message.message_id
 
 async def show_watchlist_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -280,7 +2193,7 @@ async def show_watchlist_command(update: Update, context: ContextTypes.DEFAULT_T
     else: 
         await update.message.reply_text("Fetching your watchlist... ⏳")
     
-    tickers = [row[0] for row in db_query("SELECT ticker_symbol FROM watchlist WHERE user_id = ?", (user_id,))]
+    tickers = await watchlist_index.tickers(user_id)
     
     if not tickers:
         text = "Your watchlist is empty. Add stocks using the `/search` command."
@@ -291,17 +2204,19 @@ async def show_watchlist_command(update: Update, context: ContextTypes.DEFAULT_T
 
     report_lines = ["**Your Watchlist Summary**\n"]
     keyboard = []
+    quotes = await quote_cache.get_many(tickers)
     for ticker in tickers:
         try:
-            info = yf.Ticker(ticker).info
+            info = quotes[ticker]
+            if isinstance(info, Exception): raise info
             price = info.get('regularMarketPrice', 'N/A')
             change_pct = info.get('regularMarketChangePercent', 0) * 100
             currency_code = info.get('currency', '')
-            display_symbol = {'INR': '₹', 'USD': '$'}.get(currency_code, currency_code)
+            display_symbol = CURRENCY_SYMBOLS.get(currency_code, currency_code)
             emoji = "📈" if change_pct >= 0 else "📉"
-            report_lines.append(f"• `{ticker}`: {display_symbol}{price:,.2f} ({change_pct:+.2f}%) {emoji}")
+            stale = staleness_note(ticker)
+            report_lines.append(f"• `{ticker}`: {display_symbol}{price:,.2f} ({change_pct:+.2f}%) {emoji}" + (f" _{stale}_" if stale else ""))
             keyboard.append([InlineKeyboardButton(f"➖ Remove {ticker}", callback_data=f"remove_from_list_{ticker}")])
-            await asyncio.sleep(0.1) # Be respectful to the API
         except: 
             report_lines.append(f"• `{ticker}`: Error fetching data")
     
@@ -310,41 +2225,162 @@ async def show_watchlist_command(update: Update, context: ContextTypes.DEFAULT_T
     if query:
         await query.edit_message_text(final_text, parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(keyboard))
 
-async def start_quiz(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    # <<< UPDATED: Overhauled quiz logic >>>
+async def alert_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Creates a price alert: /alert <TICKER> above|below <price> or /alert <TICKER> move <percent>."""
+    usage = "Usage: `/alert <TICKER> above|below <price>` or `/alert <TICKER> move <percent>`"
+    args = context.args or []
+    if len(args) != 3 or args[1].lower() not in AlertBook.KINDS:
+        await update.message.reply_text(usage, parse_mode='Markdown')
+        return
+    ticker, kind = args[0].upper(), args[1].lower()
+    try:
+        threshold = float(args[2].rstrip('%').replace(',', ''))
+    except ValueError:
+        threshold = 0
+    if threshold <= 0:
+        await update.message.reply_text(usage, parse_mode='Markdown')
+        return
+
+    user_id = update.effective_user.id
+    count = (await db_query("SELECT COUNT(*) FROM alerts WHERE user_id = ?", (user_id,)))[0][0]
+    if count >= MAX_ALERTS_PER_USER:
+        await update.message.reply_text(f"You already have {count} alerts. Remove some with /alerts first.")
+        return
+    rows = await db_execute("INSERT INTO alerts (user_id, ticker_symbol, kind, threshold, created) VALUES (?, ?, ?, ?, datetime('now')) RETURNING alert_id", (user_id, ticker, kind, threshold))
+    alert_book.add(rows[0][0], user_id, ticker, kind, threshold)
+    condition = f"moves more than {threshold:g}% in a day" if kind == 'move' else f"goes {kind} {threshold:,.2f}"
+    await update.message.reply_text(f"🔔 Alert set: I'll message you when `{ticker}` {condition}.", parse_mode='Markdown')
+
+async def list_alerts_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user_id = update.effective_user.id
     query = update.callback_query
+    rows = await db_query("SELECT alert_id, ticker_symbol, kind, threshold FROM alerts WHERE user_id = ? ORDER BY ticker_symbol, alert_id", (user_id,))
+    if rows:
+        text = "🔔 **Your Price Alerts**\n\nTap an alert to remove it."
+        keyboard = [[InlineKeyboardButton(f"➖ {ticker} {kind} {threshold:g}{'%' if kind == 'move' else ''}", callback_data=f"remove_alert_{alert_id}")] for alert_id, ticker, kind, threshold in rows]
+    else:
+        text = "You have no price alerts. Create one with `/alert <TICKER> above|below <price>`."
+        keyboard = []
+    keyboard.append([InlineKeyboardButton("⬅️ Back to Main Menu", callback_data="main_menu")])
+    if query:
+        await query.edit_message_text(text, parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(keyboard))
+    else:
+        await update.message.reply_text(text, parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(keyboard))
+
+async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Queues a message to every user (owner only): /broadcast <text>, or /broadcast status."""
+    if update.effective_user.id != OWNER_ID:
+        await update.message.reply_text("Sorry, this is an admin-only command.")
+        return
+    parts = update.message.text.split(None, 1) # Keep the owner's line breaks, unlike context.args
+    text = parts[1].strip() if len(parts) > 1 else ""
+    if not text:
+        await update.message.reply_text("Usage: `/broadcast <message>` or `/broadcast status`", parse_mode='Markdown')
+        return
+    if text == "status":
+        rows = await db_query("SELECT MAX(broadcast_id) FROM broadcasts")
+        if not rows or rows[0][0] is None:
+            await update.message.reply_text("No broadcasts yet.")
+            return
+        await update.message.reply_text(format_broadcast_progress(rows[0][0], await delivery_queue.progress(rows[0][0])))
+        return
+    broadcast_id, recipients = await delivery_queue.broadcast(text)
+    status_message = await update.message.reply_text(f"📣 Broadcast #{broadcast_id} queued for {recipients} users.")
+    context.application.create_task(report_broadcast_progress(status_message, broadcast_id))
+
+def format_broadcast_progress(broadcast_id: int, progress: dict) -> str:
+    total = sum(progress.values())
+    icon = "✅" if not progress['pending'] else "📣"
+    return f"{icon} Broadcast #{broadcast_id}: {progress['sent']}/{total} sent, {progress['failed']} failed, {progress['pending']} pending"
+
+async def report_broadcast_progress(message, broadcast_id: int, every: float = 5) -> None:
+    """Keeps the owner's status message up to date until the broadcast is drained."""
+    last_text = None
+    while True:
+        await asyncio.sleep(every)
+        progress = await delivery_queue.progress(broadcast_id)
+        text = format_broadcast_progress(broadcast_id, progress)
+        if text != last_text:
+            try:
+                await message.edit_text(text)
+            except Exception as e:
+                logging.warning(f"Could not update broadcast progress: {e}")
+            last_text = text
+        if not progress['pending']: return
+
+async def hold_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Records a holding on a watchlist entry: /hold <TICKER> <quantity> [average cost]; quantity 0 clears it."""
+    usage = "Usage: `/hold <TICKER> <quantity> [average cost]` (quantity `0` clears the holding)"
+    args = context.args or []
+    try:
+        if len(args) not in (2, 3): raise ValueError
+        ticker = args[0].upper(); quantity = float(args[1]); avg_cost = float(args[2]) if len(args) == 3 else None
+        if quantity < 0 or (avg_cost is not None and avg_cost <= 0): raise ValueError
+    except ValueError:
+        await update.message.reply_text(usage, parse_mode='Markdown')
+        return
+    user_id = update.effective_user.id
+    if quantity:
+        await watchlist_index.add(user_id, ticker)
+        await db_execute("UPDATE watchlist SET quantity = ?, avg_cost = ? WHERE user_id = ? AND ticker_symbol = ?", (quantity, avg_cost, user_id, ticker))
+        cost = f" at {avg_cost:,.2f}" if avg_cost is not None else ""
+        await update.message.reply_text(f"💼 Holding `{ticker}`: {quantity:g}{cost}. See `/portfolio`.", parse_mode='Markdown')
+    else:
+        await db_execute("UPDATE watchlist SET quantity = NULL, avg_cost = NULL WHERE user_id = ? AND ticker_symbol = ?", (user_id, ticker))
+        await update.message.reply_text(f"Holding in `{ticker}` cleared; it stays on your watchlist.", parse_mode='Markdown')
+
+async def portfolio_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat_id = update.effective_chat.id
+    await cleanup_previous_message(context, chat_id)
+    sent_message = await update.message.reply_text("Valuing your portfolio... ⏳")
+    keyboard = [[InlineKeyboardButton("👀 My Watchlist", callback_data="show_watchlist")], [InlineKeyboardButton("⬅️ Back to Main Menu", callback_data="main_menu")]]
+    await sent_message.edit_text(await get_portfolio_message(update.effective_user.id), parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(keyboard))
+    context.user_data['last_message_id'] = sent_message.message_id
 
-    # Initialize or get the list of unasked question indices
-    if 'unasked_quiz_indices' not in context.user_data or not context.user_data['unasked_quiz_indices']:
-        indices = list(range(len(QUIZ_QUESTIONS)))
-        random.shuffle(indices)
-        context.user_data['unasked_quiz_indices'] = indices
+async def history_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Summarises daily price history: /history <TICKER> [1mo|3mo|6mo|ytd|1y|2y|5y|max]."""
+    chat_id = update.effective_chat.id
+    await cleanup_previous_message(context, chat_id)
+    args = context.args or []
+    if not args or len(args) > 2 or (len(args) == 2 and args[1].lower() not in HISTORY_PERIODS):
+        sent_message = await update.message.reply_text(f"Usage: `/history <TICKER> [{'|'.join(HISTORY_PERIODS)}]`", parse_mode='Markdown')
+        context.user_data['last_message_id'] = sent_message.message_id
+        return
+    ticker = args[0].upper(); period = args[1].lower() if len(args) == 2 else '1y'
+    keyboard = [[InlineKeyboardButton(f"💹 {ticker} Price", callback_data=f"price_{ticker}")], [InlineKeyboardButton("⬅️ Back to Main Menu", callback_data="main_menu")]]
+    sent_message = await update.message.reply_text(await get_history_message(ticker, period), parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(keyboard))
+    context.user_data['last_message_id'] = sent_message.message_id
 
-    unasked_indices = context.user_data['unasked_quiz_indices']
+async def start_quiz(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Asks the next due or unseen question; /quiz [category] narrows it to one category."""
+    query = update.callback_query
+    chat_id = update.effective_chat.id
+    user_id = update.effective_user.id
+    category = " ".join(context.args).lower() if not query and context.args else None
+    if category and category not in quiz_bank.categories:
+        await update.message.reply_text(f"Unknown category. Choose from: {', '.join(quiz_bank.categories)}")
+        return
+    for legacy_key in ('unasked_quiz_indices', 'correct_answer_index', 'explanation'): context.user_data.pop(legacy_key, None)
 
-    # Check if all questions have been asked
-    if not unasked_indices:
-        text = "🎉 **Quiz Complete!**\n\nYou've answered all the questions. Well done!"
+    question_id, detail = await quiz_bank.next_question_id(user_id, category)
+    if question_id is None:
+        wait = f" Your next review is due in {format_age(detail)}." if detail else ""
+        text = f"🎉 **All Caught Up!**\n\nYou've answered every question that is due.{wait}"
         reply_markup = get_main_menu_keyboard()
+        context.user_data.pop('quiz_question_id', None)
         if query:
             await query.edit_message_text(text, parse_mode='Markdown', reply_markup=reply_markup)
-        else: # Should not happen with buttons, but good practice
+        else:
             await context.bot.send_message(chat_id, text, parse_mode='Markdown', reply_markup=reply_markup)
-        # Clean up quiz data for the next round
-        context.user_data.pop('unasked_quiz_indices', None)
         return
 
-    # Pop the next question index to ensure it's not asked again
-    question_index = unasked_indices.pop()
-    question_data = QUIZ_QUESTIONS[question_index]
-
-    context.user_data['correct_answer_index'] = question_data['correct']
-    context.user_data['explanation'] = question_data['explanation']
-    
-    buttons = [[InlineKeyboardButton(option, callback_data=f"quiz_{i}")] for i, option in enumerate(question_data['options'])]
+    question_data = await quiz_bank.question(question_id)
+    context.user_data['quiz_question_id'] = question_id # The only quiz state kept per user
+    buttons = [[InlineKeyboardButton(option, callback_data=f"quiz_{question_id}_{i}")] for i, option in enumerate(question_data['options'])]
     reply_markup = InlineKeyboardMarkup(buttons)
-    message_text = f"**Financial Quiz!** ({len(QUIZ_QUESTIONS) - len(unasked_indices)}/{len(QUIZ_QUESTIONS)})\n\n{question_data['question']}"
+    label = "🔁 Review" if detail else f"{await quiz_bank.answered(user_id) + 1}/{quiz_bank.size}"
+    message_text = (f"**Financial Quiz!** ({label}) · _{question_data['category'].replace('_', ' ')}_ {'⭐' * question_data['difficulty']}\n\n"
+                    f"{question_data['question']}")
     
     if query:
         await query.edit_message_text(message_text, reply_markup=reply_markup, parse_mode='Markdown')
@@ -372,11 +2408,16 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         ticker = key.split('_', 1)[1]
         await query.edit_message_text(f"Fetching price for `{ticker}`...", parse_mode='Markdown')
         message_text = await get_stock_price_message(ticker)
-        await query.edit_message_text(text=message_text, parse_mode='Markdown', reply_markup=create_stock_details_keyboard(ticker, user_id))
+        await query.edit_message_text(text=message_text, parse_mode='Markdown', reply_markup=await create_stock_details_keyboard(ticker, user_id))
     
+    elif key.startswith("history_"):
+        ticker = key.split('_', 1)[1]
+        keyboard = [[InlineKeyboardButton("⬅️ Back to Price", callback_data=f"price_{ticker}")], [InlineKeyboardButton("⬅️ Back to Main Menu", callback_data="main_menu")]]
+        await query.edit_message_text(await get_history_message(ticker, '1y'), parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(keyboard))
+
     elif key.startswith("add_from_search_"):
         ticker = key.split('_', 3)[3]
-        db_query("INSERT OR IGNORE INTO watchlist (user_id, ticker_symbol) VALUES (?, ?)", (user_id, ticker))
+        await watchlist_index.add(user_id, ticker)
         await query.answer(f"✅ {ticker} added to Watchlist!")
         new_keyboard = []
         for row in query.message.reply_markup.inline_keyboard:
@@ -389,89 +2430,403 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
     elif key.startswith("add_from_details_"):
         ticker = key.split('_', 3)[3]
-        db_query("INSERT OR IGNORE INTO watchlist (user_id, ticker_symbol) VALUES (?, ?)", (user_id, ticker))
+        await watchlist_index.add(user_id, ticker)
         await query.answer("✅ Added to Watchlist!")
-        await query.edit_message_reply_markup(reply_markup=create_stock_details_keyboard(ticker, user_id))
+        await query.edit_message_reply_markup(reply_markup=await create_stock_details_keyboard(ticker, user_id))
 
     elif key.startswith("remove_from_details_"):
         ticker = key.split('_', 3)[3]
-        db_query("DELETE FROM watchlist WHERE user_id = ? AND ticker_symbol = ?", (user_id, ticker))
+        await watchlist_index.remove(user_id, ticker)
         await query.answer("🗑️ Removed from Watchlist!")
-        await query.edit_message_reply_markup(reply_markup=create_stock_details_keyboard(ticker, user_id))
+        await query.edit_message_reply_markup(reply_markup=await create_stock_details_keyboard(ticker, user_id))
 
     elif key.startswith("remove_from_list_"):
         ticker = key.split('_', 3)[3]
-        db_query("DELETE FROM watchlist WHERE user_id = ? AND ticker_symbol = ?", (user_id, ticker))
+        await watchlist_index.remove(user_id, ticker)
         await query.answer(f"🗑️ {ticker} removed!")
         await show_watchlist_command(update, context)
 
+    elif key.startswith("remove_alert_"):
+        alert_id = int(key.split('_', 2)[2])
+        rows = await db_execute("DELETE FROM alerts WHERE alert_id = ? AND user_id = ? RETURNING ticker_symbol", (alert_id, user_id))
+        if rows: alert_book.remove(alert_id, rows[0][0])
+        await query.answer("🗑️ Alert removed!")
+        await list_alerts_command(update, context)
+
     elif key.startswith("quiz_"):
-        user_answer = int(key.split('_')[1])
-        correct_answer = context.user_data.get('correct_answer_index')
-        explanation = context.user_data.get('explanation')
-        text = f"✅ **Correct!**\n\n_{explanation}_" if user_answer == correct_answer else f"❌ **Not Quite...**\n\n_{explanation}_"
+        parts = key.split('_')
+        question_data = await quiz_bank.question(int(parts[1])) if len(parts) == 3 else None
+        if question_data is None or context.user_data.get('quiz_question_id') != question_data['id']:
+            await query.answer("This question has expired.")
+            return
+        context.user_data.pop('quiz_question_id', None)
+        correct = int(parts[2]) == question_data['correct']
+        next_review = await quiz_bank.record_answer(user_id, question_data['id'], correct)
+        verdict = "✅ **Correct!**" if correct else "❌ **Not Quite...**"
+        text = f"{verdict}\n\n_{question_data['explanation']}_\n\n🔁 You'll see this again in {format_age(next_review)}."
         keyboard = [[InlineKeyboardButton("Next Question ➡️", callback_data="start_quiz")], [InlineKeyboardButton("⬅️ Back to Tools", callback_data="show_more_tools")]]
         await query.edit_message_text(text, parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(keyboard))
 
     elif key == "show_watchlist": await show_watchlist_command(update, context)
     
     elif key == "show_more_tools":
-        # Reset quiz progress if user navigates back to tools
-        context.user_data.pop('unasked_quiz_indices', None) 
-        keyboard = [
-            [InlineKeyboardButton("🚀 Market Movers (Moneycontrol)", url="https://www.moneycontrol.com/stocks/marketstats/nsegainer/index.php")],
-            [InlineKeyboardButton("🧠 Financial Quiz", callback_data="start_quiz")], # <<< UPDATED: This now resets the quiz
-            [InlineKeyboardButton("⬅️ Back to Main Menu", callback_data="main_menu")]
-        ]
-        await query.edit_message_text("🛠️ **More Tools**\n\nSelect a tool to use:", reply_markup=InlineKeyboardMarkup(keyboard))
+        context.user_data.pop('quiz_question_id', None) 
+        await query.edit_message_text(MORE_TOOLS_TEXT, reply_markup=MORE_TOOLS_KEYBOARD)
     
     elif key == "show_market_menu":
-        keyboard = [[InlineKeyboardButton("⬅️ Back to Main Menu", callback_data="main_menu")]]
-        message = (
-            "📈 **Live Market Data**\n\n"
-            "Use `/search <company name>` to find a stock symbol.\n"
-            "**Example:** `/search Apple`\n\n"
-            "If you already know the symbol, use `/price <symbol>`.\n"
-            "**Example:** `/price AAPL`"
-        )
-        await query.edit_message_text(message, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+        await query.edit_message_text(MARKET_MENU_TEXT, reply_markup=MARKET_MENU_KEYBOARD, parse_mode='Markdown')
         
     elif key == "show_resources_menu":
-        keyboard = [[InlineKeyboardButton(FINANCIAL_LINKS[k]["title"], callback_data=k)] for k in sorted(FINANCIAL_LINKS.keys())]
-        keyboard.append([InlineKeyboardButton("⬅️ Back to Main Menu", callback_data="main_menu")])
-        await query.edit_message_text("📚 **Financial Resources**\n\nSelect a category to explore:", reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
-
-    elif key in FINANCIAL_LINKS:
-        category = FINANCIAL_LINKS[key]
-        message = f"**{category['title']}**\n_{category['description']}_\n\n"
-        for link in category["links"]:
-            message += f"🔗 [{link['name']}]({link['url']}) - {link['desc']}\n"
-        keyboard = [[InlineKeyboardButton("⬅️ Back to Resources", callback_data="show_resources_menu")]]
-        await query.edit_message_text(text=message, parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(keyboard), disable_web_page_preview=True)
+        await query.edit_message_text(RESOURCES_MENU_TEXT, reply_markup=RESOURCES_MENU_KEYBOARD, parse_mode='Markdown')
+
+    elif key in RESOURCE_PAGES:
+        await query.edit_message_text(text=RESOURCE_PAGES[key], parse_mode='Markdown', reply_markup=BACK_TO_RESOURCES_KEYBOARD, disable_web_page_preview=True)
+
+# --- Inline Mode ---
+# Requires inline mode to be enabled for the bot through @BotFather (/setinline).
+inline_lookups = {} # user_id -> task answering that user's latest inline query
+
+async def inline_query_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Answers `@bot <term>` with quote cards; every keystroke cancels the user's previous lookup."""
+    inline_query = update.inline_query
+    user_id = inline_query.from_user.id
+    lookup = asyncio.ensure_future(answer_inline_query(inline_query))
+    previous = inline_lookups.get(user_id)
+    inline_lookups[user_id] = lookup
+    if previous is not None and not previous.done():
+        previous.cancel()
+        metrics.inc("inline_superseded_total")
+    try:
+        await lookup
+    except asyncio.CancelledError:
+        if asyncio.current_task().cancelling(): # We are being cancelled ourselves, not superseded
+            lookup.cancel()
+            raise
+    finally:
+        if inline_lookups.get(user_id) is lookup: del inline_lookups[user_id]
+
+async def answer_inline_query(inline_query) -> None:
+    await asyncio.sleep(INLINE_DEBOUNCE) # Superseded keystrokes are cancelled here, before any work
+    term = inline_query.query.strip()
+    personal = not term # An empty query lists the user's own watchlist
+    names = {}
+    if personal:
+        symbols = (await watchlist_index.tickers(inline_query.from_user.id))[:INLINE_MAX_RESULTS]
+    else:
+        records = symbol_index.search(term, limit=INLINE_MAX_RESULTS) or symbol_index.search(term, limit=INLINE_MAX_RESULTS, fuzzy=True)
+        names = {r['symbol']: r['longname'] for r in records}
+        symbols = list(names) or ([term.upper()] if re.fullmatch(r"[A-Za-z0-9.^=&-]{1,20}", term) else [])
+    # Fresh and stale-but-servable quotes come straight from the cache; only real misses wait, as one batch.
+    # The shield lets a fetch outlive a superseded lookup, so it still warms the cache for the next keystroke.
+    try:
+        fetched = await asyncio.wait_for(asyncio.shield(quote_cache.get_many(symbols)), INLINE_QUOTE_TIMEOUT) if symbols else {}
+    except asyncio.TimeoutError:
+        fetched = {}
+    results = []
+    for symbol in symbols:
+        info = fetched.get(symbol)
+        if not isinstance(info, dict): info = quote_cache.peek(symbol, max_age=float('inf'))
+        name = names.get(symbol) or (info or {}).get('longName') or symbol
+        report_button = InlineKeyboardMarkup([[InlineKeyboardButton("📊 Full Report (Yahoo Finance)", url=f"https://finance.yahoo.com/quote/{symbol}")]])
+        if info and info.get('regularMarketPrice') is not None:
+            currency_code = info.get('currency', '')
+            title = f"{symbol} · {CURRENCY_SYMBOLS.get(currency_code, currency_code)}{info['regularMarketPrice']:,.2f} ({(info.get('regularMarketChangePercent') or 0) * 100:+.2f}%)"
+            text = format_quote_message(symbol, info, name, footer=None)
+        else:
+            title, text = f"{symbol} · price unavailable", f"**{name} ({symbol})**"
+        results.append(InlineQueryResultArticle(id=symbol[:64], title=title, description=name, reply_markup=report_button,
+                                                input_message_content=InputTextMessageContent(text, parse_mode='Markdown')))
+    # Telegram caches answers per query text; keep that no longer than the quotes themselves stay fresh
+    cache_time = min([int(quote_ttl(s)) for s in symbols] + [INLINE_MAX_CACHE_TIME])
+    if personal or any(staleness_note(s) for s in symbols): cache_time = min(cache_time, 10)
+    await inline_query.answer(results, cache_time=cache_time, is_personal=personal)
+
+# --- Update Processing & Webhook Serving ---
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates concurrently while applying each user's updates in arrival order.
+
+    Updates from different users run in parallel up to max_concurrent_updates. Updates from
+    the same user wait on that user's lock, and a user with too many queued updates has the
+    excess dropped so one spammer can't occupy every slot. Inline queries skip the lock: each
+    keystroke must be able to supersede the previous one rather than queue behind it. Updates admitted by the webhook
+    server are counted until they finish, which is what the server's backpressure checks.
+    """
+
+    def __init__(self, max_concurrent_updates: int, max_pending_updates: int, max_pending_per_user: int):
+        super().__init__(max_concurrent_updates)
+        self.max_pending_updates = max_pending_updates
+        self.max_pending_per_user = max_pending_per_user
+        self._user_locks = weakref.WeakValueDictionary()
+        self._user_pending = {} # user_id -> updates queued or running
+        self._admitted = set() # update_ids accepted by the webhook server and not yet finished
+        self.dropped = 0
+
+    @property
+    def pending_updates(self) -> int:
+        return len(self._admitted)
+
+    def admit(self, update_id: int) -> bool:
+        """Reserves capacity for an incoming webhook update; False means the server should push back."""
+        if len(self._admitted) >= self.max_pending_updates: return False
+        self._admitted.add(update_id)
+        return True
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        user = getattr(update, 'effective_user', None)
+        try:
+            if user is None or getattr(update, 'inline_query', None) is not None:
+                await coroutine
+                return
+            pending = self._user_pending.get(user.id, 0)
+            if pending >= self.max_pending_per_user:
+                self.dropped += 1
+                coroutine.close()
+                logging.warning(f"Dropping update {update.update_id}: user {user.id} has {pending} updates queued")
+                return
+            self._user_pending[user.id] = pending + 1
+            lock = self._user_locks.get(user.id)
+            if lock is None:
+                lock = self._user_locks[user.id] = asyncio.Lock()
+            try:
+                async with lock:
+                    await coroutine
+            finally:
+                remaining = self._user_pending.pop(user.id) - 1
+                if remaining: self._user_pending[user.id] = remaining
+        finally:
+            self._admitted.discard(getattr(update, 'update_id', None))
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        self._admitted.clear()
+
+class HttpServer:
+    """Minimal asyncio HTTP/1.1 server with keep-alive, enough for webhooks and local endpoints.
+
+    `handler(method, path, headers, body)` returns (status, content_type, body).
+    """
+
+    REASONS = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found", 413: "Payload Too Large", 503: "Service Unavailable"}
+
+    def __init__(self, handler, host: str, port: int, max_body: int = 1 << 20):
+        self.handler = handler
+        self.host = host
+        self.port = port
+        self.max_body = max_body
+        self._server = None
+        self._connections = {} # writer -> task serving it
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._serve, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            for writer in list(self._connections): # Idle keep-alive connections would otherwise outlive the server
+                writer.close()
+            await asyncio.gather(*self._connections.values(), return_exceptions=True)
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self._connections[writer] = asyncio.current_task()
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line: break
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get('content-length') or 0)
+                if length > self.max_body:
+                    status, content_type, body = 413, 'text/plain', b''
+                    headers['connection'] = 'close'
+                else:
+                    request_body = await reader.readexactly(length) if length else b''
+                    try:
+                        status, content_type, body = await self.handler(method, path, headers, request_body)
+                    except Exception as e:
+                        logging.error(f"Error handling {method} {path}: {e}")
+                        status, content_type, body = 400, 'text/plain', b''
+                extra = "Retry-After: 1\r\n" if status == 503 else ""
+                writer.write((f"HTTP/1.1 {status} {self.REASONS.get(status, '')}\r\nContent-Type: {content_type}\r\n"
+                              f"Content-Length: {len(body)}\r\n{extra}\r\n").encode('latin-1') + body)
+                await writer.drain()
+                if headers.get('connection', '').lower() == 'close': break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            self._connections.pop(writer, None)
+            writer.close()
+
+async def handle_webhook_request(application: Application, processor: PerUserUpdateProcessor, method: str, path: str, headers: dict, body: bytes) -> tuple:
+    if method != 'POST' or path.split('?', 1)[0] != WEBHOOK_PATH:
+        return 404, 'text/plain', b''
+    if WEBHOOK_SECRET and headers.get('x-telegram-bot-api-secret-token') != WEBHOOK_SECRET:
+        return 403, 'text/plain', b''
+    update = Update.de_json(json.loads(body), application.bot)
+    if not processor.admit(update.update_id):
+        return 503, 'text/plain', b'' # Telegram redelivers later, which throttles it to our pace
+    await application.update_queue.put(update)
+    return 200, 'text/plain', b''
+
+async def run_webhook(application: Application, processor: PerUserUpdateProcessor) -> None:
+    """Serves updates from Telegram webhook POSTs instead of long polling."""
+    server = HttpServer(partial(handle_webhook_request, application, processor), WEBHOOK_LISTEN, WEBHOOK_PORT)
+    stop_signal = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_signal.set)
+    try:
+        async with application: # initialize() ... shutdown()
+            if application.post_init: await application.post_init(application)
+            if WEBHOOK_URL:
+                await application.bot.set_webhook(url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET or None, max_connections=100)
+            await application.start()
+            await server.start()
+            logging.info(f"Webhook server listening on {WEBHOOK_LISTEN}:{server.port}{WEBHOOK_PATH}")
+            await stop_signal.wait()
+            await server.stop()
+            await application.stop()
+            if application.post_stop: await application.post_stop(application)
+    finally:
+        if application.post_shutdown: await application.post_shutdown(application)
+
+# --- Handler Instrumentation & Metrics Endpoint ---
+STATIC_CALLBACKS = {"main_menu", "start_quiz", "show_watchlist", "show_more_tools", "show_market_menu", "show_resources_menu"}
+CALLBACK_PREFIXES = ("price_", "add_from_search_", "add_from_details_", "remove_from_details_", "remove_from_list_", "remove_alert_", "history_", "quiz_")
+
+def callback_label(data: str) -> str:
+    """Maps callback data to a bounded metric label: its prefix, static key, or 'resource_category'."""
+    for prefix in CALLBACK_PREFIXES:
+        if data.startswith(prefix): return prefix
+    if data in STATIC_CALLBACKS: return data
+    return "resource_category" if data in FINANCIAL_LINKS else "other"
+
+def instrumented(name: str, callback):
+    """Wraps a handler callback to record its latency under `name` (or the callback prefix for buttons)."""
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        query = update.callback_query
+        label = f"button:{callback_label(query.data or '')}" if query else name
+        with metrics.track("handler", handler=label):
+            await callback(update, context)
+    return wrapper
+
+def collect_gauges() -> dict:
+    gauges = {}
+    for cache_name, lookup_cache in (("quote_cache", quote_cache), ("search_cache", search_cache)):
+        stats = lookup_cache.stats()
+        lookups = stats['hits'] + stats['misses'] + stats['coalesced']
+        gauges.update({f"{cache_name}_{k}": v for k, v in stats.items()})
+        gauges[f"{cache_name}_hit_ratio"] = round((stats['hits'] + stats['coalesced']) / lookups, 4) if lookups else 0
+    gauges.update({f"watchlist_index_{k}": v for k, v in watchlist_index.stats().items()})
+    gauges.update({f"alerts_{k}": v for k, v in alert_book.stats().items()})
+    gauges["symbol_index_size"] = len(symbol_index)
+    gauges.update({f"history_{k}": v for k, v in history_store.stats().items()})
+    gauges.update({f"outbox_{k}": v for k, v in delivery_queue.stats().items()})
+    gauges.update({f"user_state_{k}": v for k, v in user_state.stats().items()})
+    for breaker in (yahoo_quote_breaker, yahoo_search_breaker):
+        gauges[f"circuit_{breaker.name}_open"] = int(breaker.state != "closed")
+    gauges["yahoo_rate_limit"] = yahoo_rate_limiter.rate
+    return gauges
+
+async def handle_metrics_request(method: str, path: str, headers: dict, body: bytes) -> tuple:
+    if method != 'GET' or path.split('?', 1)[0] != '/metrics':
+        return 404, 'text/plain', b''
+    return 200, 'text/plain; version=0.0.4', metrics.render_prometheus(collect_gauges()).encode()
+
+metrics_server = HttpServer(handle_metrics_request, METRICS_LISTEN, METRICS_PORT)
+
+def format_stats_summary() -> str:
+    """Compact latency/upstream/cache summary for the owner's /stats."""
+    lines = ["\n**Handlers** (count · p50 · p95)"]
+    handlers = sorted(metrics.series("handler_seconds").items(), key=lambda item: -item[1].count)
+    for labels, h in handlers[:10]:
+        lines.append(f"`{dict(labels)['handler']}`: {h.count} · {h.quantile(0.5) * 1000:g}ms · {h.quantile(0.95) * 1000:g}ms")
+    lines.append("\n**Upstream** (calls · errors · avg)")
+    totals = {}
+    for labels, h in metrics.series("upstream_seconds").items():
+        upstream = dict(labels)['upstream']
+        count, total = totals.get(upstream, (0, 0.0))
+        totals[upstream] = (count + h.count, total + h.sum)
+    for upstream, (count, total) in sorted(totals.items()):
+        errors = metrics.counter_total("upstream_errors_total", upstream=upstream)
+        lines.append(f"`{upstream}`: {count} · {int(errors)} · {total / count * 1000:.0f}ms")
+    for labels, h in sorted(metrics.series("sqlite_query_seconds").items()):
+        lines.append(f"`sqlite {dict(labels)['op']}`: {h.count} · avg {h.sum / h.count * 1000:.2f}ms")
+    gauges = collect_gauges()
+    lines.append(f"\nQuote cache hit ratio: `{gauges['quote_cache_hit_ratio']:.0%}` · Search cache: `{gauges['search_cache_hit_ratio']:.0%}`")
+    lines.append(f"Stale quotes served: `{gauges['quote_cache_stale']}` · fallbacks: `{gauges['quote_cache_fallbacks']}`")
+    lines.append(" · ".join(f"`{b.name}`: {b.state}" for b in (yahoo_quote_breaker, yahoo_search_breaker)))
+    return "\n".join(lines)
 
 # --- Bot Startup ---
+async def post_init(application: Application) -> None:
+    database.start(DB_DEFERRED_FLUSH_INTERVAL)
+    alert_book.on_trigger = partial(dispatch_alerts, application)
+    await delivery_queue.start(application.bot)
+    user_state.start(application)
+    if QUOTE_REFRESH_ENABLED: quote_refresher.start()
+    if METRICS_PORT:
+        await metrics_server.start()
+        logging.info(f"Metrics available at http://{METRICS_LISTEN}:{metrics_server.port}/metrics")
+
+async def post_shutdown(application: Application) -> None:
+    await metrics_server.stop()
+    await quote_refresher.stop()
+    await delivery_queue.stop()
+    await user_state.stop()
+    await close_upstream_clients()
+    await database.close()
+
+def register_handlers(application: Application) -> None:
+    # Register command handlers; every callback is wrapped to record its latency
+    application.add_handler(CommandHandler("start", instrumented("start", start)))
+    application.add_handler(CommandHandler("stats", instrumented("stats", stats_command))) # <<< NEW: Added stats handler
+    application.add_handler(CommandHandler("search", instrumented("search", search_command)))
+    application.add_handler(CommandHandler("price", instrumented("price", price_command)))
+    application.add_handler(CommandHandler("watchlist", instrumented("watchlist", show_watchlist_command)))
+    application.add_handler(CommandHandler("alert", instrumented("alert", alert_command)))
+    application.add_handler(CommandHandler("alerts", instrumented("alerts", list_alerts_command)))
+    application.add_handler(CommandHandler("history", instrumented("history", history_command)))
+    application.add_handler(CommandHandler("hold", instrumented("hold", hold_command)))
+    application.add_handler(CommandHandler("broadcast", instrumented("broadcast", broadcast_command)))
+    application.add_handler(CommandHandler("portfolio", instrumented("portfolio", portfolio_command)))
+    application.add_handler(CommandHandler("quiz", instrumented("quiz", start_quiz)))
+    
+    # Register the main callback handler for all buttons
+    application.add_handler(CallbackQueryHandler(instrumented("button", button_handler)))
+    application.add_handler(InlineQueryHandler(instrumented("inline", inline_query_handler)))
+
 def main() -> None:
     # Use environment variable for token, with a placeholder for local testing
     TOKEN = os.environ.get("BOT_TOKEN", "8035433844:AAEVK7XMtfgrGFj__kInF0yCr3KuPdx6JEk")
     if TOKEN == "8035433844:AAEVK7XMtfgrGFj__kInF0yCr3KuPdx6JEk":
         logging.warning("Using a placeholder Bot Token. Please set the BOT_TOKEN environment variable.")
         
-    application = Application.builder().token(TOKEN).build()
-    
-    # Register command handlers
-    application.add_handler(CommandHandler("start", start))
-    application.add_handler(CommandHandler("stats", stats_command)) # <<< NEW: Added stats handler
-    application.add_handler(CommandHandler("search", search_command))
-    application.add_handler(CommandHandler("price", price_command))
-    application.add_handler(CommandHandler("watchlist", show_watchlist_command))
-    # application.add_handler(CommandHandler("quiz", start_quiz)) # optional: allow starting quiz with /quiz
-    
-    # Register the main callback handler for all buttons
-    application.add_handler(CallbackQueryHandler(button_handler))
+    if CONCURRENT_UPDATES == 1: logging.info("Processing updates sequentially: a slow upstream call delays every following update.")
+    update_processor = PerUserUpdateProcessor(CONCURRENT_UPDATES, max_pending_updates=MAX_PENDING_UPDATES, max_pending_per_user=MAX_PENDING_UPDATES_PER_USER)
+    builder = Application.builder().token(TOKEN).concurrent_updates(update_processor).persistence(user_state).post_init(post_init).post_shutdown(post_shutdown)
+    builder = builder.request(InstrumentedRequest(connection_pool_size=max(8, CONCURRENT_UPDATES)))
+    if TELEGRAM_API_BASE_URL: # e.g. a local fake Bot API for load tests
+        builder = builder.base_url(f"{TELEGRAM_API_BASE_URL.rstrip('/')}/bot").base_file_url(f"{TELEGRAM_API_BASE_URL.rstrip('/')}/file/bot")
+    application = builder.build()
+    register_handlers(application)
 
     # Set up the database and run the bot
     setup_database()
-    application.run_polling()
+    load_symbol_index()
+    load_alerts()
+    load_quiz_bank()
+    if BOT_MODE == "webhook":
+        asyncio.run(run_webhook(application, update_processor))
+    else:
+        application.run_polling()
 
 if __name__ == "__main__":
     main()